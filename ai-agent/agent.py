@@ -1,16 +1,24 @@
 import os
+import re
 import uuid
+import time
+import asyncio
 import psycopg
 import json
-from psycopg_pool import ConnectionPool
-from langchain_groq import ChatGroq
-from langchain_postgres import PostgresChatMessageHistory
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+import contextvars
+from psycopg_pool import ConnectionPool, AsyncConnectionPool, PoolTimeout
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from langgraph.graph import StateGraph, START, END
-from langgraph.checkpoint.memory import MemorySaver
-from typing import TypedDict, Annotated, List, Sequence
-from langchain_core.messages import BaseMessage
+from typing import TypedDict, Annotated, List, Sequence, Optional
+from contextlib import asynccontextmanager, nullcontext
+from langchain_core.messages import BaseMessage, messages_from_dict, message_to_dict
+from cache import TTLCache
+from listing_index import ListingIndex, LISTING_COLUMNS, parse_query, listing_digest, render_digest
+from media_urls import MediaUrlResolver, SupabaseSigner, StubSigner
+from prompt_builder import PromptBuilder
+from message_meta import classify_message, get_meta, with_meta, message_tokens, estimate_tokens
+from response_cache import ResponseCache, context_hash
+from model_dispatch import ModelDispatcher, Overloaded
+from metrics import Registry, Trace, TOKEN_BUCKETS, current_trace, use_trace, record, timed
 from dotenv import load_dotenv
 
 from pathlib import Path
@@ -27,27 +35,224 @@ DB_URL = os.getenv("DATABASE_URL", "").replace('"', '')
 if "6543" in DB_URL:
     DB_URL = DB_URL.replace(":6543", ":5432").split("?")[0]
 
-# 2. Initialize Pool and Model
-pool = ConnectionPool(DB_URL, min_size=1, max_size=10)
-default_model = ChatGroq(model="llama-3.3-70b-versatile", temperature=0.2)
-vision_model = ChatGroq(model="llama-3.3-70b-versatile", temperature=0.2)
+# Postgres connections for the whole service (all workers of one replica).
+# Each worker gets an async pool of DB_POOL_MAX plus a one-connection sync pool
+# for the blocking helpers, and waits at most DB_POOL_TIMEOUT seconds for a
+# connection before shedding the request.
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "11"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+SYNC_POOL_MAX = 1
+MIN_CONNECTIONS_PER_WORKER = 3
 
-# Initialize the table at startup
-def init_db():
+def _worker_count():
+    """WEB_CONCURRENCY as a number, or for "auto" one worker per available CPU,
+    as many as DB_MAX_CONNECTIONS can give MIN_CONNECTIONS_PER_WORKER each."""
+    value = os.getenv("WEB_CONCURRENCY", "1").strip().lower()
+    if value != "auto":
+        return max(1, int(value))
     try:
-        with pool.connection() as conn:
-            PostgresChatMessageHistory.create_tables(conn, "chat_history")
-            print("Database table 'chat_history' initialized.")
-    except Exception as e:
-        print(f"Error initializing database: {e}")
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(1, min(cpus, DB_MAX_CONNECTIONS // MIN_CONNECTIONS_PER_WORKER))
+
+# Worker processes serving the API (see agent_api.py). The connection and
+# model budgets are totals for the service and are split across workers.
+WORKERS = _worker_count()
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", str(max(2, DB_MAX_CONNECTIONS // WORKERS - SYNC_POOL_MAX))))
+if WORKERS * (DB_POOL_MAX + SYNC_POOL_MAX) > DB_MAX_CONNECTIONS:
+    print(f"Warning: {WORKERS} workers x {DB_POOL_MAX + SYNC_POOL_MAX} connections exceeds DB_MAX_CONNECTIONS={DB_MAX_CONNECTIONS}")
+
+# With more than one process (workers or replicas) a session's turns can land
+# anywhere, so nothing may depend on per-process memory: the session cache is
+# off and each turn is committed before the reply is returned.
+SHARED_SESSIONS = os.getenv("SHARED_SESSIONS", "1" if WORKERS > 1 else "0") == "1"
+
+# History window: only the most recent messages are sent to the model. Turns
+# that fall out of the window are folded into a rolling per-session summary.
+HISTORY_WINDOW_MESSAGES = int(os.getenv("HISTORY_WINDOW_MESSAGES", "20"))
+HISTORY_WINDOW_TOKENS = int(os.getenv("HISTORY_WINDOW_TOKENS", "4000"))
+SUMMARY_MIN_BATCH = int(os.getenv("SUMMARY_MIN_BATCH", "10"))
+# Each summary call folds at most SUMMARY_CHUNK_MESSAGES messages and about
+# SUMMARY_CHUNK_TOKENS tokens; one update folds at most SUMMARY_MAX_MESSAGES,
+# leaving the rest of a long backlog to later turns
+SUMMARY_CHUNK_MESSAGES = int(os.getenv("SUMMARY_CHUNK_MESSAGES", "50"))
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "4000"))
+SUMMARY_MAX_MESSAGES = int(os.getenv("SUMMARY_MAX_MESSAGES", "200"))
+# Characters of one message kept in the summary transcript
+SUMMARY_MESSAGE_CHARS = 2000
+
+# Per-process cache of recent conversation state; Postgres stays the source of truth
+SESSION_CACHE_MAX_SESSIONS = int(os.getenv("SESSION_CACHE_MAX_SESSIONS", "1000"))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "1800"))
+HISTORY_WRITE_QUEUE_SIZE = int(os.getenv("HISTORY_WRITE_QUEUE_SIZE", "1000"))
+# A failed history batch is retried this many times (0.5 s, 1 s, 2 s, ... apart)
+HISTORY_WRITE_RETRIES = int(os.getenv("HISTORY_WRITE_RETRIES", "3"))
+
+# Listing media changes rarely, so lookups are cached per listing for a few minutes
+MEDIA_CACHE_TTL = float(os.getenv("MEDIA_CACHE_TTL", "300"))
+
+# Listings retrieved server-side for each message, and how often the index is refreshed
+LISTING_RETRIEVAL_K = int(os.getenv("LISTING_RETRIEVAL_K", "5"))
+LISTING_INDEX_REFRESH = float(os.getenv("LISTING_INDEX_REFRESH", "60"))
+# Listings a request names in listing_ids are expanded from cached digests, at most this many
+LISTING_DIGEST_MAX = int(os.getenv("LISTING_DIGEST_MAX", "20"))
+
+# Opt-in cache of replies to first-turn, anonymous questions ("who are you").
+# RESPONSE_CACHE_SIMILARITY > 0 also reuses replies to near-identical wordings.
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "500"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))
+
+# Signing of storage paths in ListingImage.url (see media_urls.py). Uses the
+# frontend's Supabase settings; MEDIA_SIGNER=stub signs locally for tests.
+SUPABASE_URL = (os.getenv("SUPABASE_URL") or os.getenv("NEXT_PUBLIC_SUPABASE_URL") or "").replace('"', '')
+SUPABASE_SERVICE_ROLE_KEY = (os.getenv("SUPABASE_SERVICE_ROLE_KEY") or "").replace('"', '')
+SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET", "images")
+MEDIA_SIGNER = os.getenv("MEDIA_SIGNER", "supabase" if SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY else "none").lower()
+SIGNED_URL_EXPIRES = int(os.getenv("SUPABASE_SIGNED_URL_EXPIRES", "604800"))
+# A cached signed URL is replaced once it has less than this many seconds left
+SIGNED_URL_MIN_TTL = int(os.getenv("SIGNED_URL_MIN_TTL", "86400"))
+SIGNED_URL_CACHE_SIZE = int(os.getenv("SIGNED_URL_CACHE_SIZE", "5000"))
+
+# Batch chats (get_ai_responses, /chat/batch): size limit and default concurrency
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+# Budgets for the model provider, for the whole service; each worker enforces
+# its share. Calls that cannot start within MODEL_DEADLINE seconds are shed.
+MODEL_RPM = float(os.getenv("MODEL_RPM", "1000"))
+MODEL_TPM = float(os.getenv("MODEL_TPM", "300000"))
+MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", "32"))
+MODEL_MAX_QUEUE = int(os.getenv("MODEL_MAX_QUEUE", "200"))
+MODEL_DEADLINE = float(os.getenv("MODEL_DEADLINE", "30"))
+
+# Turns whose new message carries image parts go to VISION_MODEL, all others to CHAT_MODEL
+CHAT_MODEL = os.getenv("CHAT_MODEL", "llama-3.3-70b-versatile")
+VISION_MODEL = os.getenv("VISION_MODEL", "llama-3.3-70b-versatile")
+
+# Latency instrumentation, served by agent_api.py on /metrics. Stage timings
+# also go to the current request's Trace (see metrics.py).
+metrics = Registry()
+STAGE_SECONDS = metrics.histogram("agent_stage_seconds", "Time spent in each chat pipeline stage", labels=("stage",))
+REQUEST_SECONDS = metrics.histogram("agent_request_seconds", "End-to-end chat turn latency", labels=("mode",))
+REQUESTS = metrics.counter("agent_requests_total", "Chat turns by mode and outcome", labels=("mode", "outcome"))
+POOL_WAIT_SECONDS = metrics.histogram("agent_pool_wait_seconds", "Time spent waiting for a database connection", labels=("phase",))
+LLM_TTFT_SECONDS = metrics.histogram("agent_llm_ttft_seconds", "Time from model call to first streamed token, including dispatch queueing", labels=("model",))
+MODEL_CALLS = metrics.counter("agent_model_calls_total", "Chat model calls by chosen model", labels=("model",))
+PROMPT_TOKENS = metrics.histogram("agent_prompt_tokens", "Prompt tokens per chat model call", TOKEN_BUCKETS, labels=("model",))
+HISTORY_WRITE_ERRORS = metrics.counter("agent_history_write_errors_total", "Failed chat_history batch writes", labels=("result",))
+COMPLETION_TOKENS = metrics.histogram("agent_completion_tokens", "Completion tokens per chat model call", TOKEN_BUCKETS, labels=("model",))
+
+def stage(name: str):
+    return timed(STAGE_SECONDS, name)
+
+# 2. Pools and models are created on first use (or by startup()), so importing
+# this module does no I/O. Table setup lives in schema.py and runs once per deploy.
+pool = None
+async_pool = None
+default_model = None
+vision_model = None
+model_dispatcher = ModelDispatcher(
+    MODEL_RPM / WORKERS, MODEL_TPM / WORKERS, max(1, MODEL_MAX_CONCURRENCY // WORKERS),
+    max(1, MODEL_MAX_QUEUE // WORKERS), MODEL_DEADLINE,
+    on_wait=lambda seconds: record(STAGE_SECONDS, "model_queue", seconds)
+)
+
+def get_pool():
+    """Sync pool for the blocking helpers, created on first use."""
+    global pool
+    if pool is None:
+        pool = ConnectionPool(DB_URL, min_size=0, max_size=SYNC_POOL_MAX, timeout=DB_POOL_TIMEOUT)
+    return pool
+
+def get_models():
+    """Returns (default_model, vision_model), building the ChatGroq clients on first use."""
+    global default_model, vision_model
+    if default_model is None or vision_model is None:
+        from langchain_groq import ChatGroq
+        if default_model is None:
+            default_model = ChatGroq(model=CHAT_MODEL, temperature=0.2)
+        if vision_model is None:
+            vision_model = ChatGroq(model=VISION_MODEL, temperature=0.2)
+    return default_model, vision_model
+
+async def get_async_pool():
+    """Returns the async pool used by the request path, opening it on first use.
+
+    Safe to call concurrently. The pool cannot be opened before an event loop
+    exists, which is why it is not created at import time.
+    """
+    global async_pool
+    if async_pool is None:
+        async_pool = AsyncConnectionPool(DB_URL, min_size=1, max_size=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT, open=False)
+    await async_pool.open()
+    return async_pool
+
+# Fire-and-forget tasks, referenced here so they are not garbage collected
+_background_tasks = set()
+
+def run_in_background(coro):
+    # Fresh context: background work is not part of the current request's trace
+    task = asyncio.create_task(coro, context=contextvars.Context())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Connection hold times per request phase, in milliseconds
+pool_hold_stats = {}
 
-init_db()
+def _record_hold(phase: str, held_ms: float):
+    stats = pool_hold_stats.setdefault(phase, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+    stats["count"] += 1
+    stats["total_ms"] += held_ms
+    stats["max_ms"] = max(stats["max_ms"], held_ms)
+
+@asynccontextmanager
+async def pooled_connection(phase: str):
+    """Checks out an async pool connection and records how long `phase` waited for and held it.
+
+    Raises Overloaded if none frees up within DB_POOL_TIMEOUT, so callers shed
+    the request instead of queueing behind an exhausted pool.
+    """
+    apool = await get_async_pool()
+    requested = time.perf_counter()
+    start = None
+    try:
+        async with apool.connection() as conn:
+            start = time.perf_counter()
+            POOL_WAIT_SECONDS.observe(start - requested, phase)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add("pool_wait", start - requested)
+            try:
+                yield conn
+            finally:
+                _record_hold(phase, (time.perf_counter() - start) * 1000)
+    except PoolTimeout:
+        if start is not None:
+            raise
+        POOL_WAIT_SECONDS.observe(time.perf_counter() - requested, phase)
+        raise Overloaded("database pool exhausted", retry_after=1.0)
+
+def get_pool_stats():
+    """Pool counters from psycopg_pool plus connection hold times per phase."""
+    hold = {
+        phase: {
+            "count": s["count"],
+            "avg_ms": round(s["total_ms"] / s["count"], 2) if s["count"] else 0.0,
+            "max_ms": round(s["max_ms"], 2),
+        }
+        for phase, s in pool_hold_stats.items()
+    }
+    return {"pool": async_pool.get_stats() if async_pool is not None else {}, "hold": hold}
 
 # Tool: Fetch media for a specific listing
 def get_listing_media(listing_id: str):
     """Fetches all images and videos for a specific listing from the database."""
     try:
-        with pool.connection() as conn:
+        with get_pool().connection() as conn:
             with conn.cursor() as cur:
                 # Fetch images
                 cur.execute(
@@ -67,11 +272,160 @@ def get_listing_media(listing_id: str):
         print(f"Error fetching media: {e}")
         return []
 
+# Listing ids are cuids such as "cmij..." (25 lowercase alphanumerics)
+LISTING_ID_RE = re.compile(r'[a-z0-9]{25}')
+
+media_cache = TTLCache(2000, MEDIA_CACHE_TTL)
+
+async def aget_listings_media(listing_ids):
+    """Fetches media for many listings with one query, grouped by listing.
+
+    Returns {listing_id: [media, ...]} in the order the ids were given.
+    Results, including listings without media, are cached per listing id.
+    """
+    listing_ids = list(dict.fromkeys(listing_ids))
+    found = {}
+    missing = []
+    for lid in listing_ids:
+        cached = media_cache.get(lid)
+        if cached is None:
+            missing.append(lid)
+        else:
+            found[lid] = cached
+
+    if missing:
+        fetched = {lid: [] for lid in missing}
+        try:
+            async with pooled_connection("media") as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        'SELECT "listingId", url FROM "ListingImage" WHERE "listingId" = ANY(%s) ORDER BY "listingId", "sortOrder" ASC',
+                        (missing,)
+                    )
+                    for lid, url in await cur.fetchall():
+                        fetched[lid].append({"url": url, "type": "image"})
+        except Exception as e:
+            print(f"Error fetching media: {e}")
+            fetched = {}
+        for lid, media in fetched.items():
+            media_cache.set(lid, media)
+        found.update(fetched)
+
+    return {lid: found[lid] for lid in listing_ids if lid in found}
+
+# Storage paths in ListingImage.url are signed (and cached) before they reach
+# the prompt. Without a signer only plain http(s) URLs are shown.
+if MEDIA_SIGNER == "supabase":
+    media_signer = SupabaseSigner(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+elif MEDIA_SIGNER == "stub":
+    media_signer = StubSigner()
+else:
+    media_signer = None
+media_urls = MediaUrlResolver(media_signer, SIGNED_URL_EXPIRES, SIGNED_URL_MIN_TTL, SIGNED_URL_CACHE_SIZE, SUPABASE_BUCKET)
+
+async def resolve_media(media_by_listing):
+    """Same shape as aget_listings_media, keeping only media whose URL resolved."""
+    with stage("media_sign"):
+        resolved = await media_urls.resolve(m["url"] for media in media_by_listing.values() for m in media)
+    return {
+        lid: [dict(m, url=resolved[m["url"]]) for m in media if m["url"] in resolved]
+        for lid, media in media_by_listing.items()
+    }
+
+# In-memory index over published listings (see listing_index.py)
+listing_index = ListingIndex()
+_index_refreshing = False
+
+async def refresh_listing_index():
+    """Pulls listings changed since the last refresh into listing_index."""
+    global _index_refreshing
+    if _index_refreshing:
+        return
+    _index_refreshing = True
+    try:
+        async with pooled_connection("listing_index") as conn:
+            changed = await listing_index.refresh(conn)
+            if changed:
+                # Cached replies and digests may describe listings that just changed
+                response_cache.clear()
+                digest_cache.clear()
+                print(f"Listing index refreshed: {changed} changed, {len(listing_index)} indexed.")
+    except Exception as e:
+        print(f"Error refreshing listing index: {e}")
+    finally:
+        _index_refreshing = False
+
+async def ensure_listing_index():
+    """Loads the index on first use, then refreshes it in the background when stale."""
+    if not listing_index.last_refresh:
+        await refresh_listing_index()
+    elif time.monotonic() - listing_index.last_refresh > LISTING_INDEX_REFRESH:
+        run_in_background(refresh_listing_index())
+
+async def retrieve_listings(query: str, k: int = LISTING_RETRIEVAL_K):
+    """Top-k published listings for a chat message, using filters parsed from it."""
+    await ensure_listing_index()
+    return listing_index.search(query, k, **parse_query(query))
+
+# Digests of published listings the index does not hold yet (published since
+# the last refresh), fetched by id on demand. False marks an unknown id.
+digest_cache = TTLCache(2000, LISTING_INDEX_REFRESH)
+
+async def get_listing_digests(listing_ids):
+    """Digests (see listing_index.listing_digest) for `listing_ids`, in order.
+
+    Published listings come from listing_index, which rebuilds a digest
+    whenever the listing's "updatedAt" changes; ones published since its last
+    refresh are fetched in one query and cached. Unknown and unpublished ids
+    are skipped, so drafts are never described to the model.
+    """
+    listing_ids = list(dict.fromkeys(listing_ids))[:LISTING_DIGEST_MAX]
+    await ensure_listing_index()
+    found = {}
+    missing = []
+    for lid in listing_ids:
+        digest = listing_index.digests.get(lid)
+        if digest is None:
+            digest = digest_cache.get(lid)
+            if digest is None:
+                missing.append(lid)
+                continue
+        if digest:
+            found[lid] = digest
+
+    if missing:
+        try:
+            async with pooled_connection("listing_digest") as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(f'SELECT {LISTING_COLUMNS} FROM "Listing" WHERE id = ANY(%s) AND published = true', (missing,))
+                    names = [d.name for d in cur.description]
+                    fetched = {row[0]: listing_digest(dict(zip(names, row))) for row in await cur.fetchall()}
+        except Exception as e:
+            print(f"Error fetching listing digests: {e}")
+            fetched = None
+        if fetched is not None:
+            for lid in missing:
+                digest_cache.set(lid, fetched.get(lid, False))
+            found.update(fetched)
+
+    return [found[lid] for lid in listing_ids if lid in found]
+
+async def render_digests(heading: str, digests) -> str:
+    """Prompt lines for `digests`, with each cover image signed."""
+    with stage("media_sign"):
+        covers = await media_urls.resolve(d["cover"] for d in digests if d["cover"])
+    return heading + "\n".join(render_digest(d, covers.get(d["cover"])) for d in digests) + "\n"
+
 # Tool: Find listing by title or slug
 def find_listing(query: str):
     """Finds a listing by title or slug to get its ID."""
+    if len(listing_index):
+        res = listing_index.find(query)
+        return {"id": res["id"], "title": res["title"], "slug": res["slug"]} if res else None
+
+    # Index not loaded yet (it is filled by the first chat turn)
     try:
-        with pool.connection() as conn:
+        with get_pool().connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     'SELECT id, title, slug FROM "Listing" WHERE title ILIKE %s OR slug ILIKE %s LIMIT 1',
@@ -88,6 +442,8 @@ def find_listing(query: str):
 # 3. Define State and Graph
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], lambda x, y: x + y]
+    # {"text", "context"} when this turn may be answered from response_cache
+    cache_query: Optional[dict]
 
 SYSTEM_PROMPT = """
 You are a professional Real Estate Assistant for 'PhDreamHome'.
@@ -98,7 +454,7 @@ Your goals:
    - DO NOT invent, hallucinate, or assume any property details.
    - DO NOT provide links to external websites or example.com.
    - If a user asks for a property that you don't see in the provided context, politely inform them that you couldn't find it in our current inventory and offer to help them find something else from our available listings.
-   - EVERY property recommendation MUST be based on data provided in the current 'Additional Context from the website'.
+   - EVERY property recommendation MUST be based on data provided in the current 'Additional Context from the website', 'Listings the user is viewing on the website' or 'Listings from our inventory'.
 4. CURRENCY & LOCATION: Use the appropriate currency based on the property's location:
    - For Philippines: Use Philippine Peso (₱ or PHP).
    - For USA: Use US Dollars ($ or USD).
@@ -143,46 +499,390 @@ Your goals:
 Use the chat history and the provided listing context to provide personalized help.
 """
 
-def call_model(state: AgentState):
-    # Check if there's already a system message
-    has_system = any(isinstance(m, SystemMessage) for m in state["messages"])
+# SYSTEM_PROMPT is the stable, cacheable prefix of every model call
+prompt_builder = PromptBuilder(SYSTEM_PROMPT)
+
+def render_user_info(user_data: dict):
+    return f"\nUser Information (Already captured):\n" \
+           f"- Name: {user_data.get('name', 'Not provided')}\n" \
+           f"- Email: {user_data.get('email', 'Not provided')}\n" \
+           f"- Phone: {user_data.get('phone', 'Not provided')}\n" \
+           f"DO NOT ask for these details again as they have already been provided.\n"
+
+def render_context(additional_context: str):
+    return f"\nAdditional Context from the website:\n{additional_context}\n"
+
+async def call_model(state: AgentState):
+    # prepare_turn always puts the system prompt first, so only look there
     messages = list(state["messages"])
+    has_system = bool(messages) and isinstance(messages[0], SystemMessage)
     if not has_system:
         messages = [SystemMessage(content=SYSTEM_PROMPT)] + messages
     
-    # Check if any message contains an image
-    has_image = False
+    # The new message was classified once in prepare_turn; history never needs
+    # rescanning because stored turns are plain text by the time they are replayed
+    selection_started = time.perf_counter()
+    has_image = get_meta(messages[-1])["has_image"] if isinstance(messages[-1], HumanMessage) else False
+
+    default, vision = get_models()
+    model_to_use = vision if has_image else default
+    model_label = "vision" if has_image else "default"
+    record(STAGE_SECONDS, "model_selection", time.perf_counter() - selection_started)
+    print(f"Using model: {model_label}")
+
+    MODEL_CALLS.inc(model_label)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.marks["llm_start"] = time.perf_counter()
+        trace.info["model"] = model_label
+    with stage("llm"):
+        response = await model_dispatcher.invoke(model_to_use, messages)
+
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        PROMPT_TOKENS.observe(usage.get("input_tokens", 0), model_label)
+        COMPLETION_TOKENS.observe(usage.get("output_tokens", 0), model_label)
+        if trace is not None:
+            trace.info["prompt_tokens"] = usage.get("input_tokens", 0)
+            trace.info["completion_tokens"] = usage.get("output_tokens", 0)
+    return {"messages": [response]}
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY)
+
+def check_response_cache(state: AgentState):
+    query = state.get("cache_query")
+    if query:
+        cached = response_cache.lookup(query["text"], query["context"])
+        if cached is not None:
+            print("Response cache hit")
+            return {"messages": [with_meta(AIMessage(content=cached))]}
+    return {"messages": []}
+
+def route_after_cache(state: AgentState):
+    from langgraph.graph import END
+    # A cache hit appended the reply, so the model is skipped entirely
+    return END if isinstance(state["messages"][-1], AIMessage) else "agent"
+
+def store_response(state: AgentState):
+    query = state.get("cache_query")
+    reply = state["messages"][-1].content
+    if query and isinstance(reply, str) and reply:
+        response_cache.store(query["text"], query["context"], reply)
+    return {"messages": []}
+
+_graph = None
+
+def get_graph():
+    """Compiles the LangGraph workflow on first use (importing LangGraph is slow)."""
+    global _graph
+    if _graph is None:
+        from langgraph.graph import StateGraph, START, END
+        workflow = StateGraph(AgentState)
+        workflow.add_node("response_cache", check_response_cache)
+        workflow.add_node("agent", call_model)
+        workflow.add_node("store_response", store_response)
+        workflow.add_edge(START, "response_cache")
+        workflow.add_conditional_edges("response_cache", route_after_cache, ["agent", END])
+        workflow.add_edge("agent", "store_response")
+        workflow.add_edge("store_response", END)
+        # No checkpointer: conversation state lives in chat_history, with
+        # recent turns kept in session_cache below
+        _graph = workflow.compile()
+    return _graph
+
+# Summary and history window per session, keyed by the clean session UUID.
+# Bounded by SESSION_CACHE_MAX_SESSIONS (LRU) and SESSION_CACHE_TTL. Sized 0
+# (always a miss) when sessions are shared between processes.
+session_cache = TTLCache(0 if SHARED_SESSIONS else SESSION_CACHE_MAX_SESSIONS, SESSION_CACHE_TTL)
+
+def trim_window(messages: List[BaseMessage]):
+    """Keeps the newest messages that fit HISTORY_WINDOW_MESSAGES and HISTORY_WINDOW_TOKENS."""
+    window = []
+    budget = HISTORY_WINDOW_TOKENS
+    for msg in reversed(messages[-HISTORY_WINDOW_MESSAGES:]):
+        cost = message_tokens(msg)
+        if window and cost > budget:
+            break
+        budget -= cost
+        window.append(msg)
+    window.reverse()
+    return window
+
+async def load_history(clean_id: str):
+    """Read phase: loads the rolling summary and the recent history window.
+
+    Served from session_cache when this worker saw the session recently.
+    Otherwise fetches at most HISTORY_WINDOW_MESSAGES rows newest-first
+    (served by idx_chat_history_session_id_id). Returns (summary, messages) in
+    chronological order.
+    """
+    cached = session_cache.get(clean_id)
+    if cached is not None:
+        return cached["summary"], list(cached["messages"])
+
+    async with pooled_connection("history_read") as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT summary FROM chat_summary WHERE session_id = %s", (clean_id,))
+            row = await cur.fetchone()
+            summary = row[0] if row else None
+            await cur.execute(
+                "SELECT message FROM chat_history WHERE session_id = %s ORDER BY id DESC LIMIT %s",
+                (clean_id, HISTORY_WINDOW_MESSAGES)
+            )
+            rows = await cur.fetchall()
+
+    messages = messages_from_dict([item for (item,) in reversed(rows)])
     for msg in messages:
-        if isinstance(msg.content, list):
-            for part in msg.content:
-                if isinstance(part, dict) and part.get("type") == "image_url":
-                    has_image = True
+        # Rows written before messages were classified get it once, here
+        get_meta(msg)
+    messages = trim_window(messages)
+    session_cache.set(clean_id, {"summary": summary, "messages": messages})
+    return summary, list(messages)
+
+SUMMARY_PROMPT = """Update the running summary of a real estate chat between a client and the PhDreamHome assistant.
+Keep the client's stated needs (location, budget, property type), properties discussed and any tour or contact requests.
+Do not include phone numbers, emails or other personal details. Answer with the updated summary only, under 150 words.
+
+Current summary:
+{summary}
+
+New messages:
+{transcript}"""
+
+def transcript_line(message: dict) -> str:
+    """One transcript line for a message dict as stored in chat_history."""
+    content = message["data"]["content"]
+    if isinstance(content, list):
+        # Multimodal parts: keep the text, never the (base64) image data
+        content = " ".join(
+            part.get("text", "") if part.get("type") == "text" else "[image]"
+            for part in content if isinstance(part, dict)
+        )
+    content = str(content)
+    if len(content) > SUMMARY_MESSAGE_CHARS:
+        content = content[:SUMMARY_MESSAGE_CHARS] + "..."
+    return f"{'Client' if message['type'] == 'human' else 'Assistant'}: {content}"
+
+def render_transcript(messages):
+    """Plain-text transcript of message dicts as stored in chat_history."""
+    return "\n".join(transcript_line(m) for m in messages)
+
+def summary_chunks(messages):
+    """Splits stored message dicts into runs small enough for one summarize() call."""
+    chunk, tokens = [], 0
+    for message in messages:
+        cost = estimate_tokens(transcript_line(message))
+        if chunk and (len(chunk) >= SUMMARY_CHUNK_MESSAGES or tokens + cost > SUMMARY_CHUNK_TOKENS):
+            yield chunk
+            chunk, tokens = [], 0
+        chunk.append(message)
+        tokens += cost
+    if chunk:
+        yield chunk
+
+async def summarize(summary: str, messages):
+    """Folds stored message dicts into `summary` with one model call; see summary_chunks."""
+    result = await model_dispatcher.invoke(get_models()[0], [
+        HumanMessage(content=SUMMARY_PROMPT.format(summary=summary or "(none)", transcript=render_transcript(messages)))
+    ])
+    return result.content
+
+# Sessions whose summary is being updated right now
+_summarizing = set()
+
+# What the last update_summary check of a session found, and what this process
+# has written since: {"foldable", "slack", "written", "tokens"}. While
+# foldable + written stays under SUMMARY_MIN_BATCH and the new messages fit in
+# the window's spare tokens, nothing can have left the window, so the check
+# is skipped.
+_fold_state = TTLCache(SESSION_CACHE_MAX_SESSIONS, SESSION_CACHE_TTL)
+
+def note_written(clean_id: str, messages):
+    state = _fold_state.peek(clean_id)
+    if state is not None:
+        state["written"] += len(messages)
+        state["tokens"] += sum(message_tokens(m) for m in messages)
+
+async def update_summary(clean_id: str):
+    """Folds messages that left the history window into the session summary.
+
+    The window edge is the one load_history uses, after the token trim, so
+    nothing is dropped from context without being summarized. Runs only once
+    at least SUMMARY_MIN_BATCH unsummarized messages have left the window,
+    so the extra model call is rare.
+    """
+    if clean_id in _summarizing:
+        return
+    state = _fold_state.get(clean_id)
+    if state is not None and state["foldable"] + state["written"] < SUMMARY_MIN_BATCH and state["tokens"] <= state["slack"]:
+        return
+    _summarizing.add(clean_id)
+    try:
+        async with pooled_connection("summary_read") as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT summary, last_message_id FROM chat_summary WHERE session_id = %s", (clean_id,))
+                row = await cur.fetchone()
+                summary, last_id = row if row else ("", 0)
+                await cur.execute(
+                    "SELECT id, message FROM chat_history WHERE session_id = %s ORDER BY id DESC LIMIT %s",
+                    (clean_id, HISTORY_WINDOW_MESSAGES)
+                )
+                recent = list(reversed(await cur.fetchall()))
+                if not recent:
+                    return
+                window = trim_window(messages_from_dict([m for _, m in recent]))
+                # Oldest id still inside the window
+                cutoff = recent[-len(window)][0]
+                await cur.execute(
+                    "SELECT id, message FROM chat_history WHERE session_id = %s AND id > %s AND id < %s ORDER BY id LIMIT %s",
+                    (clean_id, last_id, cutoff, SUMMARY_MAX_MESSAGES)
+                )
+                rows = await cur.fetchall()
+
+        state = {
+            "foldable": len(rows), "written": 0, "tokens": 0,
+            "slack": HISTORY_WINDOW_TOKENS - sum(message_tokens(m) for m in window),
+        }
+        _fold_state.set(clean_id, state)
+        if len(rows) < SUMMARY_MIN_BATCH:
+            return
+
+        # Chunk by chunk, saving after each, so a long backlog never becomes
+        # one oversized model call and progress survives a failure
+        folded = 0
+        for chunk in summary_chunks([m for _, m in rows]):
+            summary = await summarize(summary, chunk)
+            folded += len(chunk)
+            async with pooled_connection("summary_write") as conn:
+                await conn.execute(
+                    "INSERT INTO chat_summary (session_id, summary, last_message_id) VALUES (%s, %s, %s) "
+                    "ON CONFLICT (session_id) DO UPDATE SET summary = EXCLUDED.summary, "
+                    "last_message_id = EXCLUDED.last_message_id, updated_at = NOW()",
+                    (clean_id, summary, rows[folded - 1][0])
+                )
+            cached = session_cache.peek(clean_id)
+            if cached is not None:
+                cached["summary"] = summary
+            state["foldable"] -= len(chunk)
+        if len(rows) == SUMMARY_MAX_MESSAGES:
+            # More may be waiting; check again after the next turn
+            _fold_state.pop(clean_id)
+    except Exception as e:
+        _fold_state.pop(clean_id)
+        print(f"Error updating summary for {clean_id}: {e}")
+    finally:
+        _summarizing.discard(clean_id)
+
+def schedule_summary_update(clean_id: str):
+    """Runs update_summary in the background so it never delays a reply."""
+    run_in_background(update_summary(clean_id))
+
+# Write-behind queue for chat_history inserts, drained by _history_writer.
+# Created on first use because it belongs to the running event loop.
+_write_queue = None
+_writer_task = None
+
+def _ensure_writer():
+    global _write_queue, _writer_task
+    loop = asyncio.get_running_loop()
+    if _writer_task is None or _writer_task.done() or _writer_task.get_loop() is not loop:
+        _write_queue = asyncio.Queue(maxsize=HISTORY_WRITE_QUEUE_SIZE)
+        _writer_task = loop.create_task(_history_writer(_write_queue), context=contextvars.Context())
+    return _write_queue
+
+async def _history_writer(queue: asyncio.Queue):
+    """Drains queued turns, inserting everything pending in one transaction.
+
+    A failed batch (e.g. Overloaded when no connection frees up) is retried
+    up to HISTORY_WRITE_RETRIES times before its turns are given up. Each
+    queued item may carry a future, resolved with True once its turn is
+    committed (False if it was given up).
+    """
+    insert = "INSERT INTO chat_history (session_id, message) VALUES (%s, %s)"
+    while True:
+        batch = [await queue.get()]
+        while not queue.empty() and len(batch) < 100:
+            batch.append(queue.get_nowait())
+        written = False
+        try:
+            values = [
+                (clean_id, json.dumps(message_to_dict(msg)))
+                for clean_id, messages, _ in batch
+                for msg in messages
+            ]
+            for attempt in range(HISTORY_WRITE_RETRIES + 1):
+                try:
+                    with stage("history_flush"):
+                        async with pooled_connection("history_write") as conn:
+                            async with conn.cursor() as cur:
+                                await cur.executemany(insert, values)
+                            await conn.commit()
+                    written = True
                     break
-        elif isinstance(msg.content, str):
-            # Check for Markdown image OR if it's a JSON string with image_url
-            if "![" in msg.content and "](" in msg.content:
-                has_image = True
-            elif '{"type": "image_url"' in msg.content or "'type': 'image_url'" in msg.content:
-                has_image = True
-        
-        if has_image:
-            break
+                except Exception as e:
+                    if attempt == HISTORY_WRITE_RETRIES:
+                        HISTORY_WRITE_ERRORS.inc("dropped")
+                        print(f"Error writing chat history ({len(batch)} turns), giving up: {e}")
+                    else:
+                        HISTORY_WRITE_ERRORS.inc("retried")
+                        print(f"Error writing chat history ({len(batch)} turns), retrying: {e}")
+                        await asyncio.sleep(0.5 * 2 ** attempt)
+            if written:
+                for clean_id, messages, _ in batch:
+                    note_written(clean_id, messages)
+                for clean_id in {clean_id for clean_id, _, _ in batch}:
+                    schedule_summary_update(clean_id)
+        finally:
+            for _, _, done in batch:
+                if done is not None and not done.done():
+                    done.set_result(written)
+                queue.task_done()
 
-    model_to_use = vision_model if has_image else default_model
-    print(f"Using model: {'vision' if has_image else 'default'}")
-    
-    response = model_to_use.invoke(messages)
-    return {"messages": [response]}
+async def save_turn(clean_id: str, user_message: HumanMessage, ai_message: AIMessage):
+    """Write phase: updates the session cache now and queues the Postgres insert.
+
+    Both messages of the turn are written together, batched with any other
+    pending turns into a single transaction. Blocks only if the queue is full,
+    or, with SHARED_SESSIONS, until the turn is committed so that the next turn
+    sees it whichever process serves it; if it could not be committed,
+    Overloaded is raised so the request fails instead of losing the turn.
+    """
+    cached = session_cache.peek(clean_id)
+    if cached is not None:
+        cached["messages"] = trim_window(cached["messages"] + [user_message, ai_message])
+        session_cache.set(clean_id, cached)
+    done = asyncio.get_running_loop().create_future() if SHARED_SESSIONS else None
+    await _ensure_writer().put((clean_id, [user_message, ai_message], done))
+    if done is not None and not await done:
+        raise Overloaded("chat history write failed", retry_after=1.0)
+
+async def flush_history_writes():
+    """Waits until every queued turn has been written to Postgres."""
+    if _write_queue is not None and _writer_task is not None and not _writer_task.done():
+        await _write_queue.join()
 
-# Define the graph
-workflow = StateGraph(AgentState)
-workflow.add_node("agent", call_model)
-workflow.add_edge(START, "agent")
-workflow.add_edge("agent", END)
+def get_cache_stats():
+    """Counters for the session, media, signed URL and response caches, plus queued history writes."""
+    session = session_cache.stats()
+    session["pending_writes"] = _write_queue.qsize() if _write_queue is not None else 0
+    session["shared_sessions"] = SHARED_SESSIONS
+    return {
+        "session": session,
+        "media": media_cache.stats(),
+        "signed_urls": media_urls.stats(),
+        "response": dict(response_cache.stats(), enabled=RESPONSE_CACHE),
+    }
 
-# Use MemorySaver for transient session state (LangGraph requirement)
-memory = MemorySaver()
-app = workflow.compile(checkpointer=memory)
+def _pool_gauge():
+    stats = async_pool.get_stats() if async_pool is not None else {}
+    return {(key,): stats.get(key, 0) for key in ("pool_size", "pool_available", "requests_waiting")}
+
+# Point-in-time values, read when /metrics is scraped
+metrics.gauge("agent_pool_connections", "Async pool connections by state", _pool_gauge, labels=("state",))
+metrics.gauge("agent_model_queue_depth", "Model calls waiting for the dispatcher", lambda: model_dispatcher.queue_depth)
+metrics.gauge("agent_model_running", "Model calls in progress", lambda: model_dispatcher.running)
+metrics.gauge("agent_pending_history_writes", "Turns queued for the history writer", lambda: _write_queue.qsize() if _write_queue is not None else 0)
+metrics.gauge("agent_session_cache_size", "Sessions held in the session cache", lambda: len(session_cache))
 
 def get_clean_session_id(session_id: str):
     try:
@@ -192,114 +892,396 @@ def get_clean_session_id(session_id: str):
         NAMESPACE_UUID = uuid.UUID('6ba7b810-9dad-11d1-80b4-00c04fd430c8')
         return str(uuid.uuid5(NAMESPACE_UUID, str(session_id)))
 
-import json
+async def base_sections(user_data: dict = None, additional_context: str = None, listing_ids: list = None):
+    """The prompt sections that depend only on the user and the website context.
 
-def get_ai_response(message: str, session_id: str = "default_session", user_data: dict = None, additional_context: str = None):
-    try:
+    `listing_ids` are listings the website shows the user; they are expanded
+    from digests instead of being described in `additional_context`.
+    """
+    sections = {
+        "user": prompt_builder.render("user", user_data, render_user_info),
+        "context": prompt_builder.render("context", additional_context, render_context),
+    }
+    if listing_ids:
+        with stage("listing_digest"):
+            digests = await get_listing_digests(listing_ids)
+        if digests:
+            sections["viewing"] = prompt_builder.section(
+                await render_digests("\nListings the user is viewing on the website:\n", digests)
+            )
+    return sections
+
+def context_key(additional_context: str = None, listing_ids: list = None) -> str:
+    """Identifies the website context for the response cache."""
+    if listing_ids:
+        additional_context = f"{additional_context or ''}\nlisting_ids:{','.join(sorted(set(listing_ids)))}"
+    return context_hash(additional_context)
+
+async def prepare_turn(message: str, session_id: str = "default_session", user_data: dict = None, additional_context: str = None,
+                       use_history: bool = True, sections: dict = None, listing_ids: list = None):
+    """Builds the graph input for one chat turn, including the history read phase.
+
+    `sections` are base_sections() computed once by a caller answering many
+    messages with the same user and context. With `use_history` False the
+    turn sees no earlier messages.
+
+    Returns (clean_id, message_content, meta, input_state), where meta is the
+    new message's classification (see message_meta.py).
+    """
+    with stage("session_id"):
         clean_id = get_clean_session_id(session_id)
-        
-        # Check if message is a JSON string (could contain structured parts with images)
-        try:
-            parsed_message = json.loads(message)
-            if isinstance(parsed_message, (list, dict)):
-                message_content = parsed_message
-            else:
-                message_content = message
-        except (json.JSONDecodeError, TypeError):
+    if listing_ids:
+        listing_ids = list(dict.fromkeys(listing_ids))[:LISTING_DIGEST_MAX]
+    
+    # Check if message is a JSON string (could contain structured parts with images)
+    try:
+        parsed_message = json.loads(message)
+        if isinstance(parsed_message, (list, dict)):
+            message_content = parsed_message
+        else:
             message_content = message
+    except (json.JSONDecodeError, TypeError):
+        message_content = message
+    
+    # Dynamic prompt sections; see PromptBuilder for how they are ordered
+    sections = dict(sections) if sections is not None else await base_sections(user_data, additional_context, listing_ids)
 
-        # Prepare dynamic system prompt components
-        user_info = ""
-        if user_data:
-            user_info = f"\nUser Information (Already captured):\n" \
-                        f"- Name: {user_data.get('name', 'Not provided')}\n" \
-                        f"- Email: {user_data.get('email', 'Not provided')}\n" \
-                        f"- Phone: {user_data.get('phone', 'Not provided')}\n" \
-                        f"DO NOT ask for these details again as they have already been provided.\n"
-        
-        context_info = ""
-        if additional_context:
-            context_info = f"\nAdditional Context from the website:\n{additional_context}\n"
-            
-            # Auto-fetch media if user asks for pictures/videos of a specific property mentioned in context
-            media_context = ""
-            if any(word in message.lower() for word in ["picture", "image", "photo", "video", "show me more"]):
-                # Try to extract property title from context or message
-                # This is a heuristic: look for property IDs or names in the context
-                try:
-                    import re
-                    # Look for IDs like "cmij..." or similar common patterns in this DB
-                    listing_ids = re.findall(r'[a-z0-9]{25}', additional_context)
-                    for lid in set(listing_ids):
-                        media = get_listing_media(lid)
-                        if media:
-                            media_context += f"\nAdditional Media for Listing {lid}:\n"
-                            for m in media:
-                                # We need to sign these URLs if they are just paths
-                                # For now, we'll provide the raw paths/URLs and let the frontend or a signing helper handle it
-                                # If the path starts with images: or videos: it needs signing
-                                media_context += f"- {m['type']}: {m['url']}\n"
-                except Exception as media_err:
-                    print(f"Error auto-fetching media context: {media_err}")
-            
-            if media_context:
-                context_info += media_context
-
-        # Check if we have an image in the current message
-        has_image = False
-        if isinstance(message_content, list):
-            for part in message_content:
-                if isinstance(part, dict) and part.get("type") == "image_url":
-                    has_image = True
+    if additional_context or listing_ids:
+        # Auto-fetch media if user asks for pictures/videos of a specific property mentioned in context
+        media_context = ""
+        if any(word in message.lower() for word in ["picture", "image", "photo", "video", "show me more"]):
+            # Try to extract property title from context or message
+            # This is a heuristic: look for property IDs or names in the context
+            try:
+                # Look for IDs like "cmij..." or similar common patterns in this DB
+                with stage("media_fetch"):
+                    media_by_listing = await aget_listings_media(
+                        (list(listing_ids or []) + LISTING_ID_RE.findall(additional_context or ""))[:LISTING_DIGEST_MAX]
+                    )
+                # Storage paths (images:..., videos:...) are signed here; media
+                # that cannot be resolved is left out rather than shown broken
+                for lid, media in (await resolve_media(media_by_listing)).items():
+                    if media:
+                        media_context += f"\nAdditional Media for Listing {lid}:\n"
+                        for m in media:
+                            media_context += f"- {m['type']}: {m['url']}\n"
+            except Exception as media_err:
+                print(f"Error auto-fetching media context: {media_err}")
+
+        sections["media"] = prompt_builder.section(media_context)
+
+    # Server-side retrieval: only the few listings relevant to this message
+    if isinstance(message_content, str):
+        query_text = message_content
+    elif isinstance(message_content, list):
+        query_text = " ".join(part.get("text", "") for part in message_content if isinstance(part, dict))
+    else:
+        query_text = ""
+    with stage("listing_retrieval"):
+        listings = await retrieve_listings(query_text) if query_text.strip() else []
+    if listings:
+        sections["listings"] = prompt_builder.section(await render_digests(
+            "\nListings from our inventory matching this message:\n", [listing_index.digests[l["id"]] for l in listings]
+        ))
+    
+    # Classify the new message once; the result travels with it into the
+    # model call and chat_history
+    meta = classify_message(message_content)
+    has_image = meta["has_image"]
+    
+    # Phase 1: short history read. The connection goes back to the pool
+    # before the model call so it is never held idle for seconds.
+    summary, past_messages = None, []
+    if use_history:
+        with stage("history_load"):
+            summary, past_messages = await load_history(clean_id)
+    if summary:
+        sections["summary"] = prompt_builder.render("summary", summary, lambda text: f"\nSummary of the earlier conversation:\n{text}\n")
+
+    if has_image:
+        # Special instruction for vision model
+        sections["vision"] = prompt_builder.section("\nIMAGE ANALYSIS: The user has provided an image. Please analyze it carefully to assist with their property sale or inquiry.\n")
+
+    # Static prefix, then history, then this turn's sections and message
+    with stage("prompt_build"):
+        messages, _ = prompt_builder.build(sections, past_messages, message_content, meta)
+
+    # Only context-free turns may share replies: no known user, no earlier
+    # turns or summary, no image
+    cache_query = None
+    if RESPONSE_CACHE and not user_data and not summary and not past_messages and not has_image and isinstance(message_content, str):
+        cache_query = {"text": message_content, "context": context_key(additional_context, listing_ids)}
+
+    return clean_id, message_content, meta, {"messages": messages, "cache_query": cache_query}
+
+async def run_turn(message: str, session_id: str = "default_session", user_data: dict = None, additional_context: str = None,
+                   use_history: bool = True, sections: dict = None, listing_ids: list = None):
+    """Read, model call and write phases of one turn. Errors propagate."""
+    clean_id, message_content, meta, input_state = await prepare_turn(
+        message, session_id, user_data, additional_context, use_history, sections, listing_ids
+    )
+
+    # Phase 2: model call, no connection held
+    config = {"configurable": {"thread_id": clean_id}}
+    final_state = await get_graph().ainvoke(input_state, config=config)
+
+    # Extract the last message from the model
+    response_text = final_state["messages"][-1].content
+
+    # Phase 3: save ONLY the new messages, batched in one transaction
+    if use_history:
+        with stage("history_write"):
+            await save_turn(clean_id, with_meta(HumanMessage(content=str(message_content)), meta), with_meta(AIMessage(content=response_text)))
+    return response_text
+
+async def aget_ai_response(message: str, session_id: str = "default_session", user_data: dict = None, additional_context: str = None, trace: Trace = None,
+                           listing_ids: list = None):
+    """Answers one chat turn. Stage timings are recorded into `trace` if given."""
+    started = time.perf_counter()
+    outcome = "error"
+    with use_trace(trace or Trace()):
+        try:
+            response_text = await run_turn(message, session_id, user_data, additional_context, listing_ids=listing_ids)
+            outcome = "ok"
+            return response_text
+        except Overloaded:
+            # Let the API turn this into a fast 503 instead of an apology reply
+            outcome = "overloaded"
+            raise
+        except Exception as e:
+            print(f"Error in get_ai_response: {e}")
+            return f"I'm sorry, I encountered an error: {str(e)}"
+        finally:
+            REQUESTS.inc("chat", outcome)
+            REQUEST_SECONDS.observe(time.perf_counter() - started, "chat")
+
+async def aget_ai_responses(items, user_data: dict = None, additional_context: str = None,
+                            use_history: bool = False, concurrency: int = None, listing_ids: list = None):
+    """Answers many messages, yielding each result as soon as it is ready.
+
+    `items` are message strings or dicts with "message" and optional "id" and
+    "session_id". All items share the user data and website context, whose
+    prompt sections are rendered once. By default no history is read or
+    written; with `use_history`, items of the same session run one at a time
+    in the given order.
+
+    Yields {"index", "id", "status": "success", "response"} or, for a failed
+    item, {"index", "id", "status": "error", "detail"} plus "retry_after" when
+    it was shed for capacity. At most `concurrency` items run at once.
+    """
+    items = [{"message": item} if isinstance(item, str) else item for item in items]
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f"Batch of {len(items)} messages exceeds BATCH_MAX_ITEMS={BATCH_MAX_ITEMS}")
+    sections = await base_sections(user_data, additional_context, listing_ids)
+    slots = asyncio.Semaphore(concurrency or BATCH_CONCURRENCY)
+    session_locks = {}
+
+    async def answer(index: int, item: dict):
+        result = {"index": index, "id": item.get("id")}
+        session_id = item.get("session_id") or "default_session"
+        # Same-session items wait for their turn before taking a slot, so they
+        # never hold slots that other sessions could use
+        lock = session_locks.setdefault(session_id, asyncio.Lock()) if use_history else nullcontext()
+        started = time.perf_counter()
+        outcome = "error"
+        async with lock, slots:
+            try:
+                with use_trace(Trace()):
+                    response = await run_turn(item["message"], session_id, user_data, additional_context, use_history, sections, listing_ids)
+                outcome = "ok"
+                return dict(result, status="success", response=response)
+            except Overloaded as e:
+                outcome = "overloaded"
+                return dict(result, status="error", detail=str(e), retry_after=e.retry_after)
+            except Exception as e:
+                print(f"Error in batch item {index}: {e}")
+                return dict(result, status="error", detail=str(e))
+            finally:
+                REQUESTS.inc("batch", outcome)
+                REQUEST_SECONDS.observe(time.perf_counter() - started, "batch")
+
+    tasks = [asyncio.create_task(answer(i, item)) for i, item in enumerate(items)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # The consumer went away (e.g. client disconnected): stop the rest
+        for task in tasks:
+            task.cancel()
+
+# Interactive blocks from SYSTEM_PROMPT that the frontend can only render whole
+STREAM_BLOCK_TAGS = ("CHOICES", "AGENT_CARD", "TOUR_FORM", "PHONE_DISPLAY", "EMAIL_DISPLAY")
+
+class BlockSafeBuffer:
+    """Holds back streamed text until no interactive block is left half-open.
+
+    Plain text is released as soon as it arrives. A block such as
+    [CHOICES] ... [/CHOICES] is released only once its closing tag has been
+    seen, and a trailing "[" that may still grow into a tag is kept back.
+    """
+
+    def __init__(self):
+        self.pending = ""
+
+    def _could_be_tag(self, text: str):
+        return any(f"[{tag}]".startswith(text) or f"[/{tag}]".startswith(text) for tag in STREAM_BLOCK_TAGS)
+
+    def feed(self, text: str) -> str:
+        """Adds a chunk and returns the part that is safe to send."""
+        self.pending += text
+        out = ""
+        while self.pending:
+            start = self.pending.find("[")
+            if start == -1:
+                out += self.pending
+                self.pending = ""
+                break
+            out += self.pending[:start]
+            self.pending = self.pending[start:]
+
+            end = self.pending.find("]")
+            if end == -1:
+                if self._could_be_tag(self.pending):
                     break
-        elif isinstance(message_content, str):
-            if "![" in message_content and "](" in message_content:
-                has_image = True
-            elif '{"type": "image_url"' in message_content or "'type': 'image_url'" in message_content:
-                has_image = True
-
-        if has_image:
-            # Special instruction for vision model
-            vision_instruction = "\nIMAGE ANALYSIS: The user has provided an image. Please analyze it carefully to assist with their property sale or inquiry.\n"
-            dynamic_system_prompt = SYSTEM_PROMPT + user_info + context_info + vision_instruction
-        else:
-            dynamic_system_prompt = SYSTEM_PROMPT + user_info + context_info
-        
-        # Get a connection from the pool
-        with pool.connection() as conn:
-            # Initialize Postgres history for persistence
-            history = PostgresChatMessageHistory(
-                "chat_history",
-                clean_id,
-                sync_connection=conn
+                out += "["
+                self.pending = self.pending[1:]
+                continue
+
+            tag = self.pending[1:end]
+            if tag in STREAM_BLOCK_TAGS:
+                close = self.pending.find(f"[/{tag}]", end)
+                if close == -1:
+                    break
+                close += len(tag) + 3
+                out += self.pending[:close]
+                self.pending = self.pending[close:]
+            else:
+                out += self.pending[:end + 1]
+                self.pending = self.pending[end + 1:]
+        return out
+
+    def flush(self) -> str:
+        """Returns whatever is still held back (e.g. an unclosed block at end of stream)."""
+        out, self.pending = self.pending, ""
+        return out
+
+async def astream_ai_response(message: str, session_id: str = "default_session", user_data: dict = None, additional_context: str = None, trace: Trace = None,
+                              listing_ids: list = None):
+    """Streams the reply as text segments, then persists the assembled text.
+
+    Segments never split an interactive block (see BlockSafeBuffer). Errors are
+    raised to the caller, which owns the transport. Stage timings, including
+    time to first token, are recorded into `trace` if given.
+    """
+    started = time.perf_counter()
+    outcome = "cancelled"
+    with use_trace(trace or Trace()) as trace:
+        try:
+            clean_id, message_content, meta, input_state = await prepare_turn(
+                message, session_id, user_data, additional_context, listing_ids=listing_ids
             )
-            
-            # Load existing messages from Postgres
-            past_messages = history.messages
-            
-            # Prepare LangGraph config
             config = {"configurable": {"thread_id": clean_id}}
-            
-            # We'll include past messages in the state to ensure the model has context
-            # Use the dynamic prompt for this call
-            messages = [SystemMessage(content=dynamic_system_prompt)] + past_messages + [HumanMessage(content=message_content)]
-            input_state = {"messages": messages}
-            
-            # Run the workflow
-            final_state = app.invoke(input_state, config=config)
-            
-            # Extract the last message from the model
-            response_message = final_state["messages"][-1]
-            response_text = response_message.content
-            
-            # Save ONLY the new messages to Postgres
-            history.add_user_message(str(message_content))
-            history.add_ai_message(response_text)
-            
-            return response_text
+
+            buffer = BlockSafeBuffer()
+            parts = []
+            async for chunk, metadata in get_graph().astream(input_state, config=config, stream_mode="messages"):
+                if metadata.get("langgraph_node") not in ("agent", "response_cache") or not isinstance(chunk, AIMessage):
+                    continue
+                if not isinstance(chunk.content, str) or not chunk.content:
+                    continue
+                if not parts and "llm_start" in trace.marks:
+                    ttft = time.perf_counter() - trace.marks["llm_start"]
+                    LLM_TTFT_SECONDS.observe(ttft, trace.info.get("model", "default"))
+                    trace.add("llm_ttft", ttft)
+                parts.append(chunk.content)
+                safe_text = buffer.feed(chunk.content)
+                if safe_text:
+                    yield safe_text
+
+            tail = buffer.flush()
+            if tail:
+                yield tail
+
+            with stage("history_write"):
+                await save_turn(clean_id, with_meta(HumanMessage(content=str(message_content)), meta), with_meta(AIMessage(content="".join(parts))))
+            outcome = "ok"
+        except Overloaded:
+            outcome = "overloaded"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            REQUESTS.inc("stream", outcome)
+            REQUEST_SECONDS.observe(time.perf_counter() - started, "stream")
+
+def _build_clients():
+    get_models()
+    get_graph()
+
+async def startup():
+    """Warms up what the first request would otherwise pay for.
+
+    The slow imports and client construction run in a worker thread so the
+    event loop keeps answering /health meanwhile.
+    """
+    await asyncio.to_thread(_build_clients)
+    await get_async_pool()
+    run_in_background(refresh_listing_index())
+
+async def shutdown():
+    """Flushes queued history writes, waits for background work and closes the pools.
+
+    The async pool and HTTP clients belong to the running event loop, so they
+    are dropped here and recreated on first use by the next loop.
+    """
+    global async_pool, pool
+    await flush_history_writes()
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await media_urls.aclose()
+    if async_pool is not None:
+        await async_pool.close()
+        async_pool = None
+    if pool is not None:
+        pool.close()
+        pool = None
+
+async def check_ready(timeout: float = 2.0):
+    """Returns (ready, detail): clients built and the database answering."""
+    if _graph is None or default_model is None:
+        return False, "warming up"
+    try:
+        apool = await get_async_pool()
+        async with apool.connection(timeout=timeout) as conn:
+            await conn.execute("SELECT 1")
+        return True, "ready"
     except Exception as e:
-        print(f"Error in get_ai_response: {e}")
-        return f"I'm sorry, I encountered an error: {str(e)}"
+        return False, f"database unavailable: {e}"
+
+def get_ai_response(message: str, session_id: str = "default_session", user_data: dict = None, additional_context: str = None,
+                    listing_ids: list = None):
+    """Blocking wrapper around aget_ai_response for scripts and the CLI.
+
+    Must not be called from inside a running event loop; use aget_ai_response there.
+    Each call runs its own event loop, so it shuts the loop's pool down when done.
+    """
+    async def run():
+        try:
+            return await aget_ai_response(message, session_id, user_data, additional_context, listing_ids=listing_ids)
+        finally:
+            await shutdown()
+    return asyncio.run(run())
+
+def get_ai_responses(items, user_data: dict = None, additional_context: str = None,
+                     use_history: bool = False, concurrency: int = None, listing_ids: list = None):
+    """Blocking wrapper around aget_ai_responses; returns the results in input order."""
+    async def run():
+        try:
+            return [r async for r in aget_ai_responses(items, user_data, additional_context, use_history, concurrency, listing_ids)]
+        finally:
+            await shutdown()
+    return sorted(asyncio.run(run()), key=lambda r: r["index"])
 
 if __name__ == "__main__":
     import sys
@@ -1,21 +1,93 @@
+"""HTTP API for the real estate agent.
+
+Runs as a single process by default. For multi-worker mode set
+WEB_CONCURRENCY to a number of workers, or "auto" for one per available CPU:
+
+    WEB_CONCURRENCY=auto DB_MAX_CONNECTIONS=40 python agent_api.py
+
+gunicorn works the same way (it reads WEB_CONCURRENCY itself; use a number):
+
+    gunicorn agent_api:app -k uvicorn.workers.UvicornWorker -b 0.0.0.0:$PORT
+
+With more than one worker, or several replicas (set SHARED_SESSIONS=1 there),
+every turn is read from and committed to Postgres, so any worker can serve any
+session. DB_MAX_CONNECTIONS and the MODEL_* budgets are totals for the service
+and are divided between workers (see agent.py). Keep DB_MAX_CONNECTIONS times
+the number of replicas below the Postgres connection limit.
+
+When a worker is saturated it answers at once instead of queueing: 503 with
+Retry-After when MAX_INFLIGHT_REQUESTS chats are already running, the model
+queue is full or no database connection frees up within DB_POOL_TIMEOUT; 429
+with Retry-After when the model provider budget is exhausted.
+"""
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel 
 from typing import List, Optional 
 import uvicorn 
 import os
+import json
+import asyncio
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 # Import the logic from the previous script 
-from agent import get_ai_response
+import agent
+from agent import aget_ai_response, astream_ai_response, aget_ai_responses, get_pool_stats, get_cache_stats, prompt_builder, model_dispatcher, Overloaded
+from metrics import Trace
 from pathlib import Path
 
 env_path = Path(__file__).parent.parent / '.env'
 load_dotenv(dotenv_path=env_path)
 
-app = FastAPI(title="Real Estate AI API") 
+# Chats this worker serves at once; beyond that requests are shed with a 503
+MAX_INFLIGHT_REQUESTS = int(os.getenv("MAX_INFLIGHT_REQUESTS", "200"))
+
+class InflightLimit:
+    """Non-blocking counter of running chats, so overload is answered, not queued."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.current = 0
+
+    def try_acquire(self) -> bool:
+        if self.current >= self.limit:
+            return False
+        self.current += 1
+        return True
+
+    def release(self):
+        self.current -= 1
+
+inflight = InflightLimit(MAX_INFLIGHT_REQUESTS)
+SHED = agent.metrics.counter("agent_shed_total", "Chat requests answered with 429/503 instead of being served", labels=("reason",))
+agent.metrics.gauge("agent_inflight_requests", "Chats being served by this worker", lambda: inflight.current)
+
+def overloaded_response(e: Overloaded, trace_id: str = None):
+    # Provider budget exhausted: clients should slow down (429). Anything else
+    # means this worker is saturated right now (503).
+    SHED.inc(e.reason)
+    headers = {"Retry-After": str(max(1, round(e.retry_after)))}
+    if trace_id:
+        headers["X-Trace-Id"] = trace_id
+    return JSONResponse(status_code=429 if e.rate_limited else 503, content={"detail": str(e)}, headers=headers)
+
+def busy_response():
+    return overloaded_response(Overloaded("too many requests in flight", retry_after=1.0))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background so the port opens immediately; /ready turns
+    # 200 once clients are built and the database answers.
+    warmup = asyncio.create_task(agent.startup())
+    yield
+    if not warmup.done():
+        warmup.cancel()
+    await agent.shutdown()
+
+app = FastAPI(title="Real Estate AI API", lifespan=lifespan) 
 
 # Enable CORS
 app.add_middleware(
@@ -33,6 +105,26 @@ class ChatRequest(BaseModel):
     history: Optional[List[dict]] = [] 
     user_data: Optional[dict] = None
     additional_context: Optional[str] = None
+    listing_ids: Optional[List[str]] = None # Listings on screen, expanded by the agent from its digest cache
+    trace: Optional[bool] = False # Return per-stage timings with the response
+
+class BatchItem(BaseModel):
+    message: str
+    id: Optional[str] = None # Echoed back so results can be matched as they arrive
+    session_id: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+    user_data: Optional[dict] = None
+    additional_context: Optional[str] = None
+    listing_ids: Optional[List[str]] = None
+    use_history: Optional[bool] = False # Read and save each item's session history
+    concurrency: Optional[int] = None # Defaults to BATCH_CONCURRENCY
+
+def request_trace(request: ChatRequest, http_request: Request):
+    """A Trace for this request and whether to return it (asked for, or an X-Trace-Id sent)."""
+    trace_id = http_request.headers.get("x-trace-id")
+    return Trace(trace_id), bool(request.trace or trace_id)
 
 @app.get("/", response_class=HTMLResponse)
 def root():
@@ -59,8 +151,42 @@ def root():
 
 @app.get("/health")
 def health_check():
+    # Liveness only: the process is up and serving
     return {"status": "healthy", "service": "ai-agent"}
 
+@app.get("/ready")
+async def readiness_check():
+    # Readiness: warm-up finished and the database is reachable
+    ready, detail = await agent.check_ready()
+    return JSONResponse(status_code=200 if ready else 503, content={"status": detail, "service": "ai-agent"})
+
+# The stats endpoints read dicts the chat handlers update, so they run on the
+# event loop (async def) rather than in the threadpool
+@app.get("/pool/stats")
+async def pool_stats():
+    # Connection pool counters and per-phase connection hold times
+    return get_pool_stats()
+
+@app.get("/cache/stats")
+async def cache_stats():
+    # Session cache hit/miss/eviction counters and write-behind queue depth
+    return get_cache_stats()
+
+@app.get("/prompt/stats")
+async def prompt_stats():
+    # Average prompt tokens per section and the rendered-section cache counters
+    return prompt_builder.stats()
+
+@app.get("/model/stats")
+async def model_stats():
+    # Model dispatch queue depth, wait times, shed and coalesced call counts
+    return model_dispatcher.stats()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    # Prometheus scrape endpoint: stage latency histograms, pool waits, token counts
+    return PlainTextResponse(agent.metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/favicon.ico", include_in_schema=False)
 async def favicon():
     # Try to serve from public if it exists, otherwise return a 204 or small placeholder
@@ -98,28 +224,135 @@ async def acme_challenge(token: str):
     return JSONResponse(status_code=404, content={"detail": "Challenge not found"})
 
 @app.post("/chat") 
-def chat_endpoint(request: ChatRequest): 
+async def chat_endpoint(request: ChatRequest, http_request: Request): 
+    trace, return_trace = request_trace(request, http_request)
+    if not inflight.try_acquire():
+        return busy_response()
     try: 
         # Ensure we have a valid session_id
         session_id = request.session_id or "default_session"
         
-        # get_ai_response is a synchronous function that performs DB and LLM I/O.
-        # By defining this endpoint with 'def' instead of 'async def', FastAPI
-        # will run it in a separate threadpool, preventing the event loop from blocking.
-        response_text = get_ai_response(
+        # aget_ai_response does all DB and LLM I/O asynchronously, so many chats
+        # can be in flight on one worker without tying up threadpool threads.
+        response_text = await aget_ai_response(
             request.message, 
             session_id=session_id,
             user_data=request.user_data,
-            additional_context=request.additional_context
+            additional_context=request.additional_context,
+            trace=trace,
+            listing_ids=request.listing_ids
         ) 
         
-        return { 
+        body = { 
             "status": "success", 
             "response": response_text, 
             "agent": "EliteRealty-Bot" 
         } 
+        if return_trace:
+            body["trace"] = trace.summary()
+        return JSONResponse(content=body, headers={"X-Trace-Id": trace.id} if return_trace else None)
+    except Overloaded as e:
+        return overloaded_response(e, trace.id if return_trace else None)
     except Exception as e: 
         raise HTTPException(status_code=500, detail=str(e)) 
+    finally:
+        inflight.release()
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest, http_request: Request):
+    session_id = request.session_id or "default_session"
+    trace, return_trace = request_trace(request, http_request)
+    if not inflight.try_acquire():
+        return busy_response()
+    sent = False
+
+    async def event_stream():
+        # Server-Sent Events: one "data" event per text segment, then "done".
+        # Interactive blocks ([CHOICES], [AGENT_CARD], ...) always arrive whole.
+        nonlocal sent
+        try:
+            async for text in astream_ai_response(
+                request.message,
+                session_id=session_id,
+                user_data=request.user_data,
+                additional_context=request.additional_context,
+                trace=trace,
+                listing_ids=request.listing_ids
+            ):
+                sent = True
+                yield f"data: {json.dumps({'token': text})}\n\n"
+            done = {"agent": "EliteRealty-Bot"}
+            if return_trace:
+                done["trace"] = trace.summary()
+            yield f"event: done\ndata: {json.dumps(done)}\n\n"
+        except Overloaded as e:
+            if not sent:
+                raise
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+        except Exception as e:
+            print(f"Error in chat stream: {e}")
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+        finally:
+            inflight.release()
+
+    # Wait for the first event before sending headers, so a shed request gets
+    # a real 429/503 rather than a 200 stream that immediately errors
+    stream = event_stream()
+    try:
+        first = await stream.__anext__()
+    except Overloaded as e:
+        return overloaded_response(e, trace.id if return_trace else None)
+
+    async def primed():
+        yield first
+        async for event in stream:
+            yield event
+
+    return StreamingResponse(
+        primed(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **({"X-Trace-Id": trace.id} if return_trace else {})}
+    )
+
+@app.post("/chat/batch")
+async def chat_batch_endpoint(request: BatchRequest):
+    # Newline-delimited JSON: one line per item in completion order (use "index"
+    # or "id" to match them up), then {"done": true, ...}
+    if len(request.items) > agent.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {agent.BATCH_MAX_ITEMS} items per batch")
+    if request.use_history and any(not item.session_id for item in request.items):
+        raise HTTPException(status_code=400, detail="use_history needs a session_id on every item")
+    if request.concurrency is not None and request.concurrency < 1:
+        raise HTTPException(status_code=400, detail="concurrency must be at least 1")
+    # The whole batch counts as one chat; its items share the model budget
+    if not inflight.try_acquire():
+        return busy_response()
+
+    async def result_stream():
+        completed = failed = 0
+        try:
+            async for result in aget_ai_responses(
+                [item.model_dump() for item in request.items],
+                user_data=request.user_data,
+                additional_context=request.additional_context,
+                use_history=request.use_history,
+                concurrency=min(request.concurrency or agent.BATCH_CONCURRENCY, agent.BATCH_CONCURRENCY),
+                listing_ids=request.listing_ids
+            ):
+                if result["status"] == "success":
+                    completed += 1
+                else:
+                    failed += 1
+                yield json.dumps(result) + "\n"
+            yield json.dumps({"done": True, "completed": completed, "failed": failed}) + "\n"
+        finally:
+            inflight.release()
+
+    return StreamingResponse(
+        result_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 if __name__ == "__main__": 
     # Get port from environment variable for deployment (e.g., Railway)
@@ -132,5 +365,9 @@ if __name__ == "__main__":
         print(f"Warning: Invalid PORT '{port_str}', falling back to 8000")
         port = 8000
         
-    # Run the server
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Run the server; several workers need the app as an import string
+    if agent.WORKERS > 1:
+        print(f"Starting {agent.WORKERS} workers, {agent.DB_POOL_MAX} database connections each")
+        uvicorn.run("agent_api:app", host="0.0.0.0", port=port, workers=agent.WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
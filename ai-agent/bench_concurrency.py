@@ -0,0 +1,75 @@
+"""Load benchmark for the /chat path against a stubbed model.
+
+Compares the old threadpool path (40 threads, each holding a pooled connection
+for the whole model call) with the async aget_ai_response path. ChatGroq is
+replaced with fake_llm.FakeChatModel, so only DATABASE_URL needs to point at a
+Postgres instance (a local one is fine) where `python schema.py` has been run.
+
+    python bench_concurrency.py --requests 200 --latency 0.5
+"""
+import argparse
+import asyncio
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import HumanMessage, AIMessage
+from langchain_postgres import PostgresChatMessageHistory
+from psycopg_pool import ConnectionPool
+
+import agent
+from fake_llm import FakeChatModel
+
+THREADPOOL_SIZE = 40  # Starlette's default threadpool size
+OLD_POOL_SIZE = 10  # The old module-level ConnectionPool(DB_URL, min_size=1, max_size=10)
+
+
+def sync_turn(pool, model, session_id: str, message: str):
+    # Mirrors the old get_ai_response: one connection held for read, model call and write
+    with pool.connection() as conn:
+        history = PostgresChatMessageHistory("chat_history", session_id, sync_connection=conn)
+        past = history.messages
+        response = model.invoke(past + [HumanMessage(content=message)])
+        history.add_messages([HumanMessage(content=message), AIMessage(content=response.content)])
+        return response.content
+
+
+def run_sync(model, n: int):
+    sessions = [str(uuid.uuid4()) for _ in range(n)]
+    # Its own pool: agent.get_pool() is now sized for the few blocking helpers
+    with ConnectionPool(agent.DB_URL, min_size=1, max_size=OLD_POOL_SIZE, timeout=300) as pool:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=THREADPOOL_SIZE) as executor:
+            list(executor.map(lambda sid: sync_turn(pool, model, sid, "Hello"), sessions))
+        return time.perf_counter() - start
+
+
+async def run_async(n: int):
+    sessions = [str(uuid.uuid4()) for _ in range(n)]
+    start = time.perf_counter()
+    await asyncio.gather(*(agent.aget_ai_response("Hello", session_id=sid) for sid in sessions))
+    await agent.flush_history_writes()
+    return time.perf_counter() - start
+
+
+def report(label: str, n: int, elapsed: float):
+    print(f"{label:<10} {n} requests in {elapsed:.2f}s -> {n / elapsed:.1f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.5, help="stub model latency in seconds")
+    args = parser.parse_args()
+
+    model = FakeChatModel(latency=args.latency)
+    agent.default_model = model
+    agent.vision_model = model
+
+    print(f"--- {args.requests} concurrent chats, stub model latency {args.latency}s ---")
+    report("sync", args.requests, run_sync(model, args.requests))
+    report("async", args.requests, asyncio.run(run_async(args.requests)))
+
+
+if __name__ == "__main__":
+    main()
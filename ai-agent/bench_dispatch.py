@@ -0,0 +1,155 @@
+"""Burst test for model_dispatch.ModelDispatcher against a fake local Groq server.
+
+Starts fake_llm's OpenAI-compatible server with a provider-style rate limit
+and fires a burst of chats at it twice: straight through ChatGroq, and
+through the dispatcher, then checks coalescing, cancellation, shedding and
+the token refund on failed calls (AssertionError if one regressed). Needs no
+database and no API key.
+
+    python bench_dispatch.py --burst 120 --provider-rpm 60 --duplicates 20
+"""
+import argparse
+import asyncio
+import time
+
+from langchain_core.messages import HumanMessage
+from langchain_groq import ChatGroq
+
+from fake_llm import run_fake_groq_server
+from model_dispatch import ModelDispatcher, Overloaded
+
+
+def make_prompts(burst: int, duplicates: int):
+    # The first `duplicates` prompts are identical and can be coalesced
+    return [
+        [HumanMessage(content="Who are you?" if i < duplicates else f"Show me listing number {i}")]
+        for i in range(burst)
+    ]
+
+
+async def direct(model, prompts):
+    async def one(messages):
+        try:
+            await model.ainvoke(messages)
+            return "ok"
+        except Exception:
+            return "error"
+    return await asyncio.gather(*(one(p) for p in prompts))
+
+
+async def dispatched(dispatcher, model, prompts):
+    async def one(messages):
+        try:
+            await dispatcher.invoke(model, messages)
+            return "ok"
+        except Overloaded:
+            return "shed"
+        except Exception:
+            return "error"
+    return await asyncio.gather(*(one(p) for p in prompts))
+
+
+class FailingModel:
+    model_name = "failing"
+
+    async def ainvoke(self, messages, **kwargs):
+        raise RuntimeError("provider error")
+
+
+async def check_cancellation(model, latency: float):
+    dispatcher = ModelDispatcher(rpm=1000, tpm=1_000_000, max_concurrency=4, max_queue=10)
+    prompt = [HumanMessage(content="Cancellation check")]
+
+    # Cancelling the first caller must not cancel a second caller coalesced onto it
+    first = asyncio.create_task(dispatcher.invoke(model, prompt))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(dispatcher.invoke(model, prompt))
+    await asyncio.sleep(latency / 4)
+    first.cancel()
+    result = await second
+    assert first.cancelled() and result.content, "coalesced caller was cancelled with the first one"
+    assert dispatcher.stats()["coalesced"] == 1
+
+    # With nobody left waiting, the provider call itself is cancelled
+    alone = asyncio.create_task(dispatcher.invoke(model, [HumanMessage(content="Abandoned call")]))
+    await asyncio.sleep(latency / 4)
+    alone.cancel()
+    await asyncio.sleep(0.05)
+    stats = dispatcher.stats()
+    assert stats["running"] == 0 and stats["in_flight_prompts"] == 0, f"abandoned call kept running: {stats}"
+
+
+async def check_shedding(model, calls: int):
+    dispatcher = ModelDispatcher(rpm=1000, tpm=1_000_000, max_concurrency=1, max_queue=2, default_deadline=30.0)
+    started = time.perf_counter()
+    outcomes = await dispatched(dispatcher, model, [[HumanMessage(content=f"Shed check {i}")] for i in range(calls)])
+    # At most one call runs and two wait; the rest are shed at once
+    assert outcomes.count("error") == 0 and outcomes.count("shed") >= calls - 3, outcomes
+    assert dispatcher.stats()["shed_queue_full"] == outcomes.count("shed")
+    return time.perf_counter() - started
+
+
+async def check_refund():
+    dispatcher = ModelDispatcher(rpm=1000, tpm=10_000, max_concurrency=1, max_queue=1)
+    before = dispatcher.tokens.level
+    try:
+        await dispatcher.invoke(FailingModel(), [HumanMessage(content="x" * 4000)])
+    except RuntimeError:
+        pass
+    assert dispatcher.tokens.level >= before - 1, "failed call kept its token estimate"
+
+
+def report(label: str, outcomes, elapsed: float, fake):
+    counts = {k: outcomes.count(k) for k in ("ok", "shed", "error")}
+    print(f"{label:<12} {counts} in {elapsed:.2f}s; provider saw {fake.state.received} requests, rejected {fake.state.rejected}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--burst", type=int, default=120)
+    parser.add_argument("--duplicates", type=int, default=20, help="identical prompts in the burst")
+    parser.add_argument("--provider-rpm", type=int, default=60, help="rate limit enforced by the fake server")
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--deadline", type=float, default=5.0, help="dispatcher queueing deadline in seconds")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    prompts = make_prompts(args.burst, args.duplicates)
+    model_kwargs = dict(model="llama-3.3-70b-versatile", api_key="fake", base_url=f"http://127.0.0.1:{args.port}", max_retries=0)
+
+    server, fake = run_fake_groq_server(args.port, latency=args.latency, rpm_limit=args.provider_rpm)
+    print(f"--- burst of {args.burst} ({args.duplicates} identical), provider limit {args.provider_rpm} rpm ---")
+    start = time.perf_counter()
+    outcomes = asyncio.run(direct(ChatGroq(**model_kwargs), prompts))
+    report("direct", outcomes, time.perf_counter() - start, fake)
+    server.should_exit = True
+
+    server, fake = run_fake_groq_server(args.port + 1, latency=args.latency, rpm_limit=args.provider_rpm)
+    model_kwargs["base_url"] = f"http://127.0.0.1:{args.port + 1}"
+    # Stay just under the provider's limit
+    dispatcher = ModelDispatcher(rpm=args.provider_rpm * 0.9, tpm=1_000_000, max_concurrency=16,
+                                 max_queue=args.burst, default_deadline=args.deadline)
+    start = time.perf_counter()
+    outcomes = asyncio.run(dispatched(dispatcher, ChatGroq(**model_kwargs), prompts))
+    report("dispatched", outcomes, time.perf_counter() - start, fake)
+    stats = dispatcher.stats()
+    print(stats)
+    assert fake.state.rejected == 0, "dispatcher let the provider rate limit trip"
+    assert stats["coalesced"] >= 1 and fake.state.received == args.burst - stats["coalesced"] - stats["shed_queue_full"] - stats["shed_deadline"], \
+        "identical prompts were not coalesced"
+    server.should_exit = True
+
+    # The burst used up the rate-limited server's window, so the remaining
+    # checks get a fresh server without a provider limit
+    server, fake = run_fake_groq_server(args.port + 2, latency=args.latency)
+    model_kwargs["base_url"] = f"http://127.0.0.1:{args.port + 2}"
+    model = ChatGroq(**model_kwargs)
+    asyncio.run(check_cancellation(model, args.latency))
+    shed_seconds = asyncio.run(check_shedding(model, 10))
+    asyncio.run(check_refund())
+    print(f"checks ok: coalescing, cancellation, shedding ({shed_seconds:.2f}s for 10 calls), token refund")
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
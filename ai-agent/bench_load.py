@@ -0,0 +1,317 @@
+"""Offline load test for the agent API.
+
+Runs agent_api.py in a subprocess against a local Postgres, with the model
+served by fake_llm's deterministic Groq stand-in (fixed reply, configurable
+latency and per-token streaming delay), so no API key or network is needed.
+Drives /chat (or /chat/stream) from --concurrency clients spread over
+--sessions sessions, and reports latency percentiles, throughput, pool
+saturation and server memory growth. Results are saved as JSON; pass an
+earlier result as --baseline to fail on regressions.
+
+    python schema.py
+    python bench_load.py --requests 500 --concurrency 50 --sessions 100 --latency 0.3
+    python bench_load.py --baseline bench_results/last-good.json
+
+DATABASE_URL must point at a Postgres you can write to (a local one is fine).
+The sessions created by the run are deleted afterwards unless --keep-history.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+import psycopg
+
+from fake_llm import run_fake_groq_server
+
+HERE = Path(__file__).parent
+MESSAGES = [
+    "Hello, who are you?",
+    "Do you have condos for rent in Cebu?",
+    "Show me houses for sale under 10 million",
+    "What about Makati?",
+    "Can I schedule a tour?",
+]
+
+
+def percentile(values, pct: float):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))]
+
+
+def _rss_kb(pid: int):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def rss_mb(pid: int):
+    """Resident memory of `pid` and its child processes (workers) in MB, read
+    from /proc (None where unavailable)."""
+    try:
+        total = _rss_kb(pid)
+    except OSError:
+        return None
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # Field 4 is the parent pid; the name in field 2 may contain spaces
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            if ppid == pid:
+                total += _rss_kb(int(entry))
+        except (OSError, ValueError, IndexError):
+            pass
+    return round(total / 1024, 1)
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/ready")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.05)
+    raise TimeoutError(f"agent API not ready after {timeout}s")
+
+
+async def one_request(client: httpx.AsyncClient, stream: bool, session_id: str, message: str):
+    """Returns (status, latency_s, first_byte_s)."""
+    payload = {"message": message, "session_id": session_id}
+    start = time.perf_counter()
+    if not stream:
+        response = await client.post("/chat", json=payload)
+        elapsed = time.perf_counter() - start
+        return response.status_code, elapsed, elapsed
+    first_byte = None
+    async with client.stream("POST", "/chat/stream", json=payload) as response:
+        async for line in response.aiter_lines():
+            if first_byte is None and line.startswith("data:"):
+                first_byte = time.perf_counter() - start
+            if line.startswith("event: error"):
+                return "stream_error", time.perf_counter() - start, first_byte
+        return response.status_code, time.perf_counter() - start, first_byte
+
+
+async def sample(client: httpx.AsyncClient, pid: int, samples: list, stop: asyncio.Event, interval: float):
+    """Polls pool and dispatcher state plus server memory until `stop` is set."""
+    while not stop.is_set():
+        try:
+            pool = (await client.get("/pool/stats")).json()["pool"]
+            model = (await client.get("/model/stats")).json()
+            samples.append({
+                "t": time.perf_counter(),
+                "pool_size": pool.get("pool_size", 0),
+                "pool_available": pool.get("pool_available", 0),
+                "pool_max": pool.get("pool_max", 0),
+                "requests_waiting": pool.get("requests_waiting", 0),
+                "model_queue_depth": model.get("queue_depth", 0),
+                "rss_mb": rss_mb(pid),
+            })
+        except httpx.HTTPError:
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def drive(args, base: str, pid: int, session_ids):
+    limits = httpx.Limits(max_connections=args.concurrency + 4, max_keepalive_connections=args.concurrency + 4)
+    async with httpx.AsyncClient(base_url=base, timeout=args.timeout, limits=limits) as client:
+        await wait_ready(client)
+        for i in range(args.warmup):
+            await one_request(client, args.stream, session_ids[i % len(session_ids)], MESSAGES[0])
+        rss_start = rss_mb(pid)
+
+        results = []
+        counter = iter(range(args.requests))
+        stop = asyncio.Event()
+        samples = []
+        sampler = asyncio.create_task(sample(client, pid, samples, stop, args.sample_interval))
+
+        async def worker():
+            for i in counter:
+                # Round-robin over sessions so each accumulates history over the run
+                session_id = session_ids[i % len(session_ids)]
+                message = MESSAGES[(i // len(session_ids)) % len(MESSAGES)]
+                try:
+                    results.append(await one_request(client, args.stream, session_id, message))
+                except httpx.HTTPError as e:
+                    results.append((type(e).__name__, None, None))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await sampler
+        rss_end = rss_mb(pid)
+        metrics_text = (await client.get("/metrics")).text
+    return results, elapsed, samples, rss_start, rss_end, metrics_text
+
+
+def stage_means(metrics_text: str):
+    """Mean seconds per pipeline stage, from the agent_stage_seconds histogram on /metrics."""
+    sums, counts = {}, {}
+    for line in metrics_text.splitlines():
+        for suffix, target in (("_sum", sums), ("_count", counts)):
+            prefix = f"agent_stage_seconds{suffix}{{stage=\""
+            if line.startswith(prefix):
+                stage, value = line[len(prefix):].split("\"} ")
+                target[stage] = float(value)
+    return {stage: round(sums[stage] / counts[stage] * 1000, 2) for stage in sums if counts.get(stage)}
+
+
+def summarize(args, results, elapsed, samples, rss_start, rss_end, metrics_text):
+    ok = sorted(latency for status, latency, _ in results if status == 200)
+    first_bytes = sorted(fb for status, _, fb in results if status == 200 and fb is not None)
+    statuses = {}
+    for status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    def ms(value):
+        return round(value * 1000, 1) if value is not None else None
+
+    rss_values = [s["rss_mb"] for s in samples if s["rss_mb"] is not None]
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "statuses": statuses,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": ms(percentile(ok, 50)), "p95": ms(percentile(ok, 95)), "p99": ms(percentile(ok, 99)),
+            "mean": ms(sum(ok) / len(ok)) if ok else None, "max": ms(ok[-1]) if ok else None,
+        },
+        "first_byte_ms": {
+            "p50": ms(percentile(first_bytes, 50)), "p95": ms(percentile(first_bytes, 95)),
+        } if args.stream else None,
+        "pool": {
+            "max": max((s["pool_max"] for s in samples), default=None),
+            "peak_in_use": max((s["pool_size"] - s["pool_available"] for s in samples), default=None),
+            "peak_waiting": max((s["requests_waiting"] for s in samples), default=None),
+            "saturated_samples": sum(1 for s in samples if s["pool_available"] == 0 and s["pool_size"] == s["pool_max"]),
+            "samples": len(samples),
+        },
+        "model_queue_peak": max((s["model_queue_depth"] for s in samples), default=None),
+        "memory_mb": {
+            "start": rss_start,
+            "end": rss_end,
+            "peak": max(rss_values, default=None),
+            "growth": round(rss_end - rss_start, 1) if rss_start is not None and rss_end is not None else None,
+        },
+        "stage_mean_ms": stage_means(metrics_text),
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float):
+    """Returns a list of regressions beyond `tolerance` (a fraction) versus a baseline result."""
+    problems = []
+    for pct in ("p50", "p95", "p99"):
+        old, new = baseline["summary"]["latency_ms"].get(pct), result["summary"]["latency_ms"].get(pct)
+        if old and new and new > old * (1 + tolerance):
+            problems.append(f"latency {pct} {old} -> {new} ms")
+    old, new = baseline["summary"]["throughput_rps"], result["summary"]["throughput_rps"]
+    if old and new < old * (1 - tolerance):
+        problems.append(f"throughput {old} -> {new} req/s")
+    if result["summary"]["ok"] < result["summary"]["requests"]:
+        problems.append(f"{result['summary']['requests'] - result['summary']['ok']} failed requests")
+    return problems
+
+
+def cleanup(session_ids):
+    clean_ids = [str(uuid.UUID(sid)) for sid in session_ids]
+    db_url = os.getenv("DATABASE_URL", "").replace('"', '')
+    with psycopg.connect(db_url, autocommit=True) as conn:
+        conn.execute("DELETE FROM chat_history WHERE session_id::text = ANY(%s)", (clean_ids,))
+        conn.execute("DELETE FROM chat_summary WHERE session_id = ANY(%s)", (clean_ids,))
+
+
+def print_summary(summary: dict):
+    lat = summary["latency_ms"]
+    print(f"requests    {summary['ok']}/{summary['requests']} ok {summary['statuses']} in {summary['elapsed_s']}s "
+          f"-> {summary['throughput_rps']} req/s")
+    print(f"latency ms  p50 {lat['p50']}  p95 {lat['p95']}  p99 {lat['p99']}  max {lat['max']}")
+    if summary["first_byte_ms"]:
+        print(f"first byte  p50 {summary['first_byte_ms']['p50']}  p95 {summary['first_byte_ms']['p95']} ms")
+    pool = summary["pool"]
+    print(f"pool        peak in use {pool['peak_in_use']}/{pool['max']}, peak waiting {pool['peak_waiting']}, "
+          f"saturated in {pool['saturated_samples']}/{pool['samples']} samples; model queue peak {summary['model_queue_peak']}")
+    mem = summary["memory_mb"]
+    print(f"memory MB   {mem['start']} -> {mem['end']} (peak {mem['peak']}, growth {mem['growth']})")
+    print("stages ms   " + "  ".join(f"{stage} {value}" for stage, value in summary["stage_mean_ms"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--stream", action="store_true", help="drive /chat/stream instead of /chat")
+    parser.add_argument("--latency", type=float, default=0.3, help="fake model latency in seconds")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="fake model delay per streamed token")
+    parser.add_argument("--timeout", type=float, default=60.0, help="client timeout per request")
+    parser.add_argument("--sample-interval", type=float, default=0.25)
+    parser.add_argument("--port", type=int, default=8020)
+    parser.add_argument("--fake-port", type=int, default=8776)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra server environment")
+    parser.add_argument("--out", help="result file (default: bench_results/load-<timestamp>.json)")
+    parser.add_argument("--baseline", help="earlier result to compare against; exits 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression vs baseline (fraction)")
+    parser.add_argument("--keep-history", action="store_true", help="keep the chat rows written by the run")
+    args = parser.parse_args()
+
+    run_fake_groq_server(args.fake_port, latency=args.latency, token_delay=args.token_delay)
+    env = dict(os.environ, PORT=str(args.port), GROQ_API_KEY="fake", GROQ_API_BASE=f"http://127.0.0.1:{args.fake_port}")
+    env.update(item.split("=", 1) for item in args.env)
+    session_ids = [str(uuid.uuid4()) for _ in range(args.sessions)]
+
+    server = subprocess.Popen([sys.executable, "agent_api.py"], cwd=HERE, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        outcome = asyncio.run(drive(args, f"http://127.0.0.1:{args.port}", server.pid, session_ids))
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+        if not args.keep_history:
+            cleanup(session_ids)
+
+    summary = summarize(args, *outcome)
+    result = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "summary": summary,
+    }
+    print_summary(summary)
+
+    out = Path(args.out) if args.out else HERE / "bench_results" / f"load-{datetime.now():%Y%m%d-%H%M%S}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, indent=2))
+    print(f"saved       {out}")
+
+    if args.baseline:
+        problems = compare(result, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION  {problem}")
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
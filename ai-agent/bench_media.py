@@ -0,0 +1,139 @@
+"""Benchmark for the auto-fetched listing media lookup.
+
+Compares the old path (one SELECT per listing id, run sequentially) with the
+batched aget_listings_media query, cold and with a warm cache, then signing
+the storage paths one by one versus through agent.media_urls (one batched,
+cached call per bucket; a stub signer with --sign-latency per call stands in
+for the Storage API). Seeds its own
+"ListingImage" table in a throwaway `bench_media` schema, so DATABASE_URL can
+point at any Postgres instance you are allowed to create schemas in.
+
+    python bench_media.py --listings 20 --images 8 --rounds 20 --sign-latency 0.05
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import psycopg
+
+# Everything below runs inside the bench schema (libpq reads PGOPTIONS)
+BENCH_SCHEMA = "bench_media"
+os.environ["PGOPTIONS"] = f"-c search_path={BENCH_SCHEMA}"
+
+import agent
+from media_urls import MediaUrlResolver, StubSigner
+
+
+def seed(listings: int, images: int):
+    with psycopg.connect(agent.DB_URL, autocommit=True) as conn:
+        conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        conn.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+        conn.execute(
+            'CREATE TABLE "ListingImage" (id TEXT PRIMARY KEY, "listingId" TEXT NOT NULL, '
+            'url TEXT NOT NULL, "sortOrder" INTEGER NOT NULL DEFAULT 0)'
+        )
+        conn.execute('CREATE INDEX ON "ListingImage" ("listingId", "sortOrder")')
+        ids = [f"bench{i:020d}" for i in range(listings)]
+        with conn.cursor() as cur:
+            cur.executemany(
+                'INSERT INTO "ListingImage" (id, "listingId", url, "sortOrder") VALUES (%s, %s, %s, %s)',
+                [(f"{lid}-{n}", lid, f"images:listings/{lid}/{n}.jpg", n) for lid in ids for n in range(images)]
+            )
+    return ids
+
+
+def drop():
+    with psycopg.connect(agent.DB_URL, autocommit=True) as conn:
+        conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+
+
+async def old_path(ids):
+    # The previous implementation: one pooled connection and query per listing
+    result = {}
+    for lid in ids:
+        async with agent.pooled_connection("media") as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    'SELECT url, "sortOrder" FROM "ListingImage" WHERE "listingId" = %s ORDER BY "sortOrder" ASC',
+                    (lid,)
+                )
+                result[lid] = [{"url": row[0], "type": "image"} for row in await cur.fetchall()]
+    return result
+
+
+async def batched_cold(ids):
+    agent.media_cache.clear()
+    return await agent.aget_listings_media(ids)
+
+
+class SlowStubSigner(StubSigner):
+    """StubSigner with a fixed delay per call, like a round trip to the Storage API."""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+
+    async def __call__(self, bucket, paths, expires):
+        await asyncio.sleep(self.latency)
+        return await super().__call__(bucket, paths, expires)
+
+
+def media_urls(media_by_listing):
+    return [m["url"] for media in media_by_listing.values() for m in media]
+
+
+async def timed(label: str, fn, ids, rounds: int):
+    await fn(ids)  # warm up the pool
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await fn(ids)
+    avg_ms = (time.perf_counter() - start) / rounds * 1000
+    print(f"{label:<16} {avg_ms:8.2f} ms per lookup")
+
+
+async def run(ids, rounds: int, sign_latency: float):
+    assert await old_path(ids) == await batched_cold(ids)
+    await timed("old (per id)", old_path, ids, rounds)
+    await timed("batched, cold", batched_cold, ids, rounds)
+    await timed("batched, cached", agent.aget_listings_media, ids, rounds)
+
+    urls = media_urls(await agent.aget_listings_media(ids))
+    signer = SlowStubSigner(sign_latency)
+    resolver = MediaUrlResolver(signer)
+
+    async def sign_each(_):
+        # Signing every path on every render, one call per URL
+        return [await signer("images", [url.split(":", 1)[1]], 3600) for url in urls]
+
+    async def resolve_cold(_):
+        return await MediaUrlResolver(signer).resolve(urls)
+
+    async def resolve_cached(_):
+        return await resolver.resolve(urls)
+
+    print(f"--- signing {len(urls)} paths, {sign_latency * 1000:.0f} ms per signer call ---")
+    await timed("sign each", sign_each, ids, max(1, rounds // 10))
+    await timed("resolver, cold", resolve_cold, ids, rounds)
+    await timed("resolver, cached", resolve_cached, ids, rounds)
+    assert len(await resolver.resolve(urls)) == len(urls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--listings", type=int, default=20)
+    parser.add_argument("--images", type=int, default=8, help="images per listing")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--sign-latency", type=float, default=0.05, help="seconds per stub signer call")
+    args = parser.parse_args()
+
+    ids = seed(args.listings, args.images)
+    try:
+        print(f"--- {args.listings} listings x {args.images} images, {args.rounds} rounds ---")
+        asyncio.run(run(ids, args.rounds, args.sign_latency))
+    finally:
+        drop()
+
+
+if __name__ == "__main__":
+    main()
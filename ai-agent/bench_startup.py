@@ -0,0 +1,79 @@
+"""Startup benchmark for the agent API.
+
+Measures, each in a fresh process:
+  - how long `import agent` takes
+  - time until agent_api.py answers /health (port open) and /ready (warm)
+  - latency of the first and second /chat request
+
+The model is served by fake_llm's local Groq stand-in, so no API key is
+needed. DATABASE_URL must point at a Postgres where `python schema.py` has
+been run.
+
+    python bench_startup.py --port 8010
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+
+from fake_llm import run_fake_groq_server
+
+HERE = Path(__file__).parent
+
+
+def measure_import() -> float:
+    code = "import time; t = time.perf_counter(); import agent; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=HERE, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def wait_for(url: str, started: float, timeout: float = 60.0) -> float:
+    while time.perf_counter() - started < timeout:
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.02)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+def timed_chat(base: str) -> float:
+    start = time.perf_counter()
+    response = httpx.post(f"{base}/chat", json={"message": "Hello, who are you?", "session_id": str(uuid.uuid4())}, timeout=30.0)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--fake-port", type=int, default=8766)
+    parser.add_argument("--latency", type=float, default=0.1, help="fake model latency in seconds")
+    args = parser.parse_args()
+
+    run_fake_groq_server(args.fake_port, latency=args.latency)
+    env = dict(os.environ, PORT=str(args.port), GROQ_API_KEY="fake", GROQ_API_BASE=f"http://127.0.0.1:{args.fake_port}")
+    base = f"http://127.0.0.1:{args.port}"
+
+    print(f"import agent        {measure_import() * 1000:8.0f} ms")
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "agent_api.py"], cwd=HERE, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        print(f"/health answers     {wait_for(base + '/health', started) * 1000:8.0f} ms")
+        print(f"/ready answers      {wait_for(base + '/ready', started) * 1000:8.0f} ms")
+        print(f"first /chat         {timed_chat(base) * 1000:8.0f} ms")
+        print(f"second /chat        {timed_chat(base) * 1000:8.0f} ms")
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
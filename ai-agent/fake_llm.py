@@ -0,0 +1,138 @@
+import json
+import time
+import asyncio
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic stand-in for ChatGroq used by the benchmarks.
+
+    Replies with a fixed text after `latency` seconds. When streamed, the reply
+    is emitted word by word with `token_delay` seconds between chunks.
+    """
+
+    reply: str = "Here is a lovely condo in Cebu. ![Condo](https://example.invalid/condo.jpg) [CHOICES] View Listing | Schedule a Tour [/CHOICES]"
+    latency: float = 0.5
+    token_delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _chunks(self) -> List[str]:
+        words = self.reply.split(" ")
+        return [w if i == 0 else " " + w for i, w in enumerate(words)]
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.reply))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.reply))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any):
+        time.sleep(self.latency)
+        for text in self._chunks():
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+            if run_manager:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any):
+        await asyncio.sleep(self.latency)
+        for text in self._chunks():
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+            if run_manager:
+                await run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+
+def create_fake_groq_app(reply: str = FakeChatModel.model_fields["reply"].default, latency: float = 0.5,
+                         token_delay: float = 0.0, rpm_limit: int = 0):
+    """A local stand-in for the Groq API (OpenAI-compatible chat completions).
+
+    Point a real client at it with ChatGroq(base_url="http://127.0.0.1:<port>").
+    With `rpm_limit` > 0 it answers 429 once more than that many requests
+    arrived in the last 60 seconds, like the real provider. `received` and
+    `rejected` count requests for the caller's assertions.
+    """
+    from collections import deque
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    fake = FastAPI(title="Fake Groq")
+    fake.state.received = 0
+    fake.state.rejected = 0
+    recent = deque()
+    words = FakeChatModel(reply=reply)._chunks()
+
+    def envelope(obj: str, model: str, **fields):
+        return {"id": "chatcmpl-fake", "object": obj, "created": int(time.time()), "model": model, **fields}
+
+    @fake.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "fake")
+        fake.state.received += 1
+
+        now = time.monotonic()
+        while recent and now - recent[0] > 60:
+            recent.popleft()
+        if rpm_limit and len(recent) >= rpm_limit:
+            fake.state.rejected += 1
+            retry_after = max(1, int(60 - (now - recent[0])))
+            return JSONResponse(
+                status_code=429,
+                content={"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                headers={"retry-after": str(retry_after)},
+            )
+        recent.append(now)
+
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+        await asyncio.sleep(latency)
+
+        if not body.get("stream"):
+            return envelope("chat.completion", model, usage=usage, choices=[
+                {"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}
+            ])
+
+        async def events():
+            for text in words:
+                if token_delay:
+                    await asyncio.sleep(token_delay)
+                chunk = envelope("chat.completion.chunk", model, choices=[
+                    {"index": 0, "delta": {"role": "assistant", "content": text}, "finish_reason": None}
+                ])
+                yield f"data: {json.dumps(chunk)}\n\n"
+            final = envelope("chat.completion.chunk", model, x_groq={"usage": usage}, choices=[
+                {"index": 0, "delta": {}, "finish_reason": "stop"}
+            ])
+            yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return fake
+
+
+def run_fake_groq_server(port: int = 8765, **options):
+    """Starts the fake Groq API in a daemon thread and returns (server, app)."""
+    import threading
+    import uvicorn
+
+    fake = create_fake_groq_app(**options)
+    server = uvicorn.Server(uvicorn.Config(fake, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, fake
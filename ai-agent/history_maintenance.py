@@ -0,0 +1,299 @@
+"""Maintenance job for chat_history: archive, compact and expire idle sessions.
+
+A session's age is the time since its newest message. Idle sessions are
+streamed from a server-side cursor in batches of --batch-size, so the job runs
+in constant memory on any table size.
+
+    # Archive the raw history of sessions idle for 30+ days (gzip JSONL)
+    python history_maintenance.py export --idle-days 30 --out archive.jsonl.gz
+
+    # Replace their history with one chat_summary row, archiving rows first
+    python history_maintenance.py compact --idle-days 30 --export archive.jsonl.gz
+
+    # Delete sessions idle for a year, including compacted ones
+    python history_maintenance.py purge --idle-days 365
+
+compact and purge delete in batches of at most --delete-batch rows, each in
+its own short transaction, so they never hold long locks. --dry-run only
+counts what would be changed. Progress and throughput are printed while
+running; run it from cron or a scheduled container next to the API.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import psycopg
+
+import agent
+
+HISTORY_COMPACT_DAYS = float(os.getenv("HISTORY_COMPACT_DAYS", "30"))
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "365"))
+
+IDLE_SESSIONS = (
+    "SELECT session_id, max(id) FROM chat_history "
+    "GROUP BY session_id HAVING max(created_at) < %s ORDER BY session_id"
+)
+
+
+class Progress:
+    """Counts sessions and rows and prints throughput every `every` seconds."""
+
+    def __init__(self, label: str, every: float = 5.0):
+        self.label = label
+        self.every = every
+        self.started = self.reported = time.monotonic()
+        self.sessions = 0
+        self.rows = 0
+
+    def add(self, sessions: int = 0, rows: int = 0):
+        self.sessions += sessions
+        self.rows += rows
+        if time.monotonic() - self.reported >= self.every:
+            self.report()
+
+    def report(self, done: bool = False):
+        self.reported = time.monotonic()
+        elapsed = max(self.reported - self.started, 1e-9)
+        print(
+            f"{self.label}{' done' if done else ''}: {self.sessions} sessions, {self.rows} rows "
+            f"in {elapsed:.1f}s ({self.sessions / elapsed:.1f} sessions/s, {self.rows / elapsed:.0f} rows/s)",
+            flush=True
+        )
+
+
+class Archive:
+    """Appends chat_history rows to a gzip-compressed JSONL file (no-op without a path)."""
+
+    def __init__(self, path: str = None):
+        self.file = gzip.open(path, "at", encoding="utf-8") if path else None
+
+    def write(self, row):
+        if self.file is None:
+            return
+        row_id, session_id, created_at, message = row
+        self.file.write(json.dumps({
+            "id": row_id,
+            "session_id": str(session_id),
+            "created_at": created_at.isoformat(),
+            "message": message,
+        }) + "\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def cutoff_for(idle_days: float):
+    return datetime.now(timezone.utc) - timedelta(days=idle_days)
+
+
+async def idle_sessions(reader, cutoff, batch_size: int):
+    """Yields batches of (session_id, last_id) for sessions idle since `cutoff`.
+
+    Uses a named (server-side) cursor on its own connection, so only one batch
+    is in memory at a time.
+    """
+    async with reader.cursor(name="idle_sessions") as cur:
+        await cur.execute(IDLE_SESSIONS, (cutoff,))
+        while True:
+            rows = await cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+
+async def stream_history(session_ids, cutoff):
+    """Streams the rows of `session_ids` older than `cutoff`, ordered by session then id."""
+    async with agent.pooled_connection("maintenance") as conn:
+        async with conn.cursor() as cur:
+            async for row in cur.stream(
+                "SELECT id, session_id, created_at, message FROM chat_history "
+                "WHERE session_id = ANY(%s) AND created_at < %s ORDER BY session_id, id",
+                (session_ids, cutoff)
+            ):
+                yield row
+
+
+async def count_history(session_ids, cutoff) -> int:
+    async with agent.pooled_connection("maintenance") as conn:
+        cur = await conn.execute(
+            "SELECT count(*) FROM chat_history WHERE session_id = ANY(%s) AND created_at < %s",
+            (session_ids, cutoff)
+        )
+        return (await cur.fetchone())[0]
+
+
+async def delete_in_batches(where: str, params, limit: int, archive: Archive = None) -> int:
+    """Deletes matching chat_history rows `limit` at a time, one transaction per batch."""
+    deleted = 0
+    while True:
+        async with agent.pooled_connection("maintenance") as conn:
+            async with conn.transaction():
+                cur = await conn.execute(
+                    f"DELETE FROM chat_history WHERE id IN (SELECT id FROM chat_history WHERE {where} LIMIT %s) "
+                    "RETURNING id, session_id, created_at, message",
+                    (*params, limit)
+                )
+                rows = await cur.fetchall()
+        if archive is not None:
+            for row in rows:
+                archive.write(row)
+        deleted += len(rows)
+        if len(rows) < limit:
+            return deleted
+
+
+async def export(args, reader, archive: Archive, progress: Progress):
+    cutoff = cutoff_for(args.idle_days)
+    async for sessions in idle_sessions(reader, cutoff, args.batch_size):
+        rows = 0
+        async for row in stream_history([sid for sid, _ in sessions], cutoff):
+            archive.write(row)
+            rows += 1
+        progress.add(len(sessions), rows)
+
+
+async def compact_session(args, session_id, last_id: int, rows, archive: Archive):
+    """Folds a session's unsummarized rows into chat_summary, then deletes its history."""
+    for row in rows:
+        archive.write(row)
+
+    async with agent.pooled_connection("maintenance") as conn:
+        cur = await conn.execute(
+            "SELECT summary, last_message_id FROM chat_summary WHERE session_id = %s", (str(session_id),)
+        )
+        found = await cur.fetchone()
+    summary, summarized_id = found if found else ("", 0)
+
+    pending = [message for row_id, _, _, message in rows if row_id > summarized_id]
+    for chunk in agent.summary_chunks(pending):
+        summary = await agent.summarize(summary, chunk)
+
+    if pending:
+        async with agent.pooled_connection("maintenance") as conn:
+            await conn.execute(
+                "INSERT INTO chat_summary (session_id, summary, last_message_id) VALUES (%s, %s, %s) "
+                "ON CONFLICT (session_id) DO UPDATE SET summary = EXCLUDED.summary, "
+                "last_message_id = EXCLUDED.last_message_id, updated_at = NOW()",
+                (str(session_id), summary, last_id)
+            )
+            await conn.commit()
+    # Rows up to last_id are now covered by the summary; newer ones are left alone
+    return await delete_in_batches("session_id = %s AND id <= %s", (session_id, last_id), args.delete_batch)
+
+
+async def compact(args, reader, archive: Archive, progress: Progress):
+    cutoff = cutoff_for(args.idle_days)
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def run(session_id, last_id, rows):
+        try:
+            progress.add(1, await compact_session(args, session_id, last_id, rows, archive))
+        except Exception as e:
+            print(f"Error compacting session {session_id}: {e}")
+        finally:
+            slots.release()
+
+    async for sessions in idle_sessions(reader, cutoff, args.batch_size):
+        session_ids = [sid for sid, _ in sessions]
+        if args.dry_run:
+            progress.add(len(sessions), await count_history(session_ids, cutoff))
+            continue
+        last_ids = dict(sessions)
+        tasks = []
+        # Reading pauses while all slots are busy, so at most `concurrency`
+        # sessions' rows are held in memory
+        async for session_id, rows in _group_by_session(stream_history(session_ids, cutoff)):
+            await slots.acquire()
+            tasks.append(asyncio.create_task(run(session_id, last_ids[session_id], rows)))
+        await asyncio.gather(*tasks)
+
+
+async def _group_by_session(rows):
+    current, group = None, []
+    async for row in rows:
+        if group and row[1] != current:
+            yield current, group
+            group = []
+        current = row[1]
+        group.append(row)
+    if group:
+        yield current, group
+
+
+async def purge(args, reader, archive: Archive, progress: Progress):
+    cutoff = cutoff_for(args.idle_days)
+    async for sessions in idle_sessions(reader, cutoff, args.batch_size):
+        session_ids = [sid for sid, _ in sessions]
+        if args.dry_run:
+            progress.add(len(sessions), await count_history(session_ids, cutoff))
+            continue
+        deleted = await delete_in_batches(
+            "session_id = ANY(%s) AND created_at < %s", (session_ids, cutoff), args.delete_batch, archive
+        )
+        async with agent.pooled_connection("maintenance") as conn:
+            await conn.execute(
+                "DELETE FROM chat_summary WHERE session_id = ANY(%s::text[])", ([str(sid) for sid in session_ids],)
+            )
+            await conn.commit()
+        progress.add(len(sessions), deleted)
+
+    # Compacted sessions have a summary but no history rows left
+    expired = "SELECT s.session_id FROM chat_summary s WHERE s.updated_at < %s AND NOT EXISTS " \
+              "(SELECT 1 FROM chat_history h WHERE h.session_id = s.session_id::uuid)"
+    while True:
+        async with agent.pooled_connection("maintenance") as conn:
+            if args.dry_run:
+                cur = await conn.execute(f"SELECT count(*) FROM ({expired}) e", (cutoff,))
+                progress.add((await cur.fetchone())[0])
+                return
+            cur = await conn.execute(
+                f"DELETE FROM chat_summary WHERE session_id IN ({expired} LIMIT %s)", (cutoff, args.delete_batch)
+            )
+            await conn.commit()
+        progress.add(cur.rowcount)
+        if cur.rowcount < args.delete_batch:
+            return
+
+
+COMMANDS = {"export": export, "compact": compact, "purge": purge}
+
+
+async def run(args):
+    progress = Progress(args.command + (" (dry run)" if args.dry_run else ""))
+    archive = Archive(args.out if args.command == "export" else args.export)
+    try:
+        async with await psycopg.AsyncConnection.connect(agent.DB_URL) as reader:
+            await COMMANDS[args.command](args, reader, archive, progress)
+    finally:
+        archive.close()
+        progress.report(done=True)
+        await agent.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=COMMANDS)
+    parser.add_argument("--idle-days", type=float, help=f"session age in days (default: {HISTORY_COMPACT_DAYS:g} "
+                        f"for export and compact, {HISTORY_RETENTION_DAYS:g} for purge)")
+    parser.add_argument("--out", help="export: archive file to write (gzip JSONL)")
+    parser.add_argument("--export", help="compact/purge: also archive every deleted row to this file")
+    parser.add_argument("--batch-size", type=int, default=500, help="sessions fetched per cursor batch")
+    parser.add_argument("--delete-batch", type=int, default=1000, help="max rows deleted per transaction")
+    parser.add_argument("--concurrency", type=int, default=4, help="compact: sessions summarized at once")
+    parser.add_argument("--dry-run", action="store_true", help="compact/purge: only count what would change")
+    args = parser.parse_args()
+
+    if args.idle_days is None:
+        args.idle_days = HISTORY_RETENTION_DAYS if args.command == "purge" else HISTORY_COMPACT_DAYS
+    if args.command == "export" and not args.out:
+        parser.error("export needs --out")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+import re
+import math
+import time
+from collections import defaultdict
+
+SITE_URL = "https://www.phdreamhome.com"
+
+# Currency per country, matching the CURRENCY & LOCATION rule in SYSTEM_PROMPT
+CURRENCY_BY_COUNTRY = {
+    "philippines": "₱",
+    "usa": "$",
+    "united states": "$",
+    "uae": "AED ",
+    "united arab emirates": "AED ",
+    "singapore": "S$",
+}
+
+# Results scoring below this fraction of the best match are dropped
+MIN_RELATIVE_SCORE = 0.5
+
+# How much a query term counts when it appears in each field
+FIELD_WEIGHTS = {"title": 3.0, "city": 2.5, "type": 2.0, "status": 1.0, "location": 1.5, "features": 1.0}
+
+STOPWORDS = {
+    "a", "an", "and", "any", "are", "at", "by", "do", "for", "have", "i", "in", "is", "looking",
+    "me", "my", "near", "of", "on", "or", "please", "show", "some", "the", "to", "want", "with", "you",
+}
+
+LISTING_COLUMNS = (
+    'id, title, slug, city, state, country, type, status, price, bedrooms, bathrooms, '
+    '"floorArea", "lotArea", "indoorFeatures", "outdoorFeatures", published, "updatedAt", '
+    '(SELECT url FROM "ListingImage" i WHERE i."listingId" = "Listing".id ORDER BY "sortOrder" LIMIT 1) AS cover'
+)
+
+# Spellings folded to one token on both the index and the query side
+SYNONYMS = {"condominium": "condo", "apartment": "condo", "flat": "condo", "lot": "land"}
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_BEDROOMS_RE = re.compile(r"(\d+)\s*(?:-\s*)?(?:br|bed|beds|bedroom|bedrooms)\b")
+_PRICE_RE = re.compile(
+    r"(under|below|less than|max|within|over|above|more than|at least)\s*(php|₱|\$|aed|s\$)?\s*([\d,.]+)\s*"
+    r"(k|m|mil|million)?\b(\s*(?:php|pesos?|usd|dollars?|aed))?"
+    # Distances, durations and counts are not prices ("within 10 minutes")
+    r"(?!\s*(?:%|percent|min|mins|minutes?|hours?|hrs?|km|kms|kilomet(?:er|re)s?|met(?:er|re)s?|miles?|"
+    r"floors?|stor(?:ey|ie)s?|blocks?|sqm|sq|square|years?|yrs?|days?|weeks?|months?|beds?|bedrooms?|br|baths?|bathrooms?)\b)"
+)
+# A bare number with no currency or unit only counts as a price from here up
+MIN_PLAIN_PRICE = 1000
+
+
+def tokenize(text) -> list:
+    """Lowercase word tokens with a naive plural strip ("condos" -> "condo")."""
+    tokens = []
+    for tok in _TOKEN_RE.findall(str(text or "").lower()):
+        if len(tok) > 3 and tok.endswith("s") and not tok.endswith("ss"):
+            tok = tok[:-1]
+        tokens.append(SYNONYMS.get(tok, tok))
+    return tokens
+
+
+def format_price(price, country) -> str:
+    symbol = CURRENCY_BY_COUNTRY.get(str(country or "").strip().lower(), "₱")
+    return f"{symbol}{price:,}"
+
+
+def parse_query(text: str) -> dict:
+    """Pulls structured filters out of a chat message.
+
+    Recognizes bedrooms ("3 bedroom", "2br"), price bounds ("under 5M",
+    "above 20k", "below ₱800") and status ("for rent", "for sale"). A number
+    is a price only with a currency, a k/m unit, or from MIN_PLAIN_PRICE up,
+    so "within 10 minutes" or "less than 5 km" add no filter. Everything else
+    is left to the ranked text match.
+    """
+    lowered = (text or "").lower()
+    filters = {}
+    match = _BEDROOMS_RE.search(lowered)
+    if match:
+        filters["min_bedrooms"] = int(match.group(1))
+    for word, currency, amount, unit, currency_after in _PRICE_RE.findall(lowered):
+        try:
+            value = float(amount.replace(",", ""))
+        except ValueError:
+            continue
+        if not (currency or unit or currency_after) and value < MIN_PLAIN_PRICE:
+            continue
+        value *= {"k": 1_000, "m": 1_000_000, "mil": 1_000_000, "million": 1_000_000}.get(unit, 1)
+        key = "max_price" if word in ("under", "below", "less than", "max", "within") else "min_price"
+        filters[key] = int(value)
+    if "for rent" in lowered or "rental" in lowered:
+        filters["status"] = "for rent"
+    elif "for sale" in lowered or "buy" in lowered:
+        filters["status"] = "for sale"
+    return filters
+
+
+class ListingIndex:
+    """In-memory search index over published listings.
+
+    Each listing is tokenized per field into an inverted index. `search` ranks
+    listings by field-weighted IDF of the matching query terms, after applying
+    structured filters (city, type, status, price, bedrooms). `refresh` pulls
+    only rows whose "updatedAt" moved since the last refresh; a periodic full
+    rebuild drops listings that were deleted.
+
+    Every indexed listing also has a precomputed digest (see listing_digest)
+    in `digests`, rebuilt whenever the listing is upserted.
+    """
+
+    def __init__(self, full_rebuild_every: float = 3600.0):
+        self.listings = {}
+        self.postings = defaultdict(dict)  # token -> {listing_id: weight}
+        self.slugs = {}
+        self.digests = {}
+        self.last_updated_at = None
+        self.last_refresh = 0.0
+        self.last_full_rebuild = 0.0
+        self.full_rebuild_every = full_rebuild_every
+
+    def __len__(self):
+        return len(self.listings)
+
+    def _fields(self, listing: dict) -> dict:
+        return {
+            "title": listing["title"],
+            "city": listing["city"],
+            "type": listing["type"],
+            "status": listing["status"],
+            "location": f"{listing['state']} {listing['country']}",
+            "features": " ".join((listing.get("indoorFeatures") or []) + (listing.get("outdoorFeatures") or [])),
+        }
+
+    def _remove(self, listing_id: str):
+        listing = self.listings.pop(listing_id, None)
+        if listing is None:
+            return
+        self.digests.pop(listing_id, None)
+        self.slugs.pop(listing["slug"].lower(), None)
+        for field_text in self._fields(listing).values():
+            for tok in set(tokenize(field_text)):
+                self.postings.get(tok, {}).pop(listing_id, None)
+
+    def upsert(self, listing: dict):
+        self._remove(listing["id"])
+        if not listing.get("published", True):
+            return
+        self.listings[listing["id"]] = listing
+        self.digests[listing["id"]] = listing_digest(listing)
+        self.slugs[listing["slug"].lower()] = listing["id"]
+        for field, field_text in self._fields(listing).items():
+            for tok in set(tokenize(field_text)):
+                weights = self.postings[tok]
+                weights[listing["id"]] = weights.get(listing["id"], 0.0) + FIELD_WEIGHTS[field]
+
+    async def refresh(self, conn):
+        """Loads listings changed since the last refresh using an async connection."""
+        full = self.last_updated_at is None or time.monotonic() - self.last_full_rebuild > self.full_rebuild_every
+        async with conn.cursor() as cur:
+            if full:
+                await cur.execute(f'SELECT {LISTING_COLUMNS} FROM "Listing" WHERE published = true')
+            else:
+                await cur.execute(f'SELECT {LISTING_COLUMNS} FROM "Listing" WHERE "updatedAt" > %s', (self.last_updated_at,))
+            names = [d.name for d in cur.description]
+            rows = [dict(zip(names, row)) for row in await cur.fetchall()]
+
+        if full:
+            self.listings.clear()
+            self.digests.clear()
+            self.postings.clear()
+            self.slugs.clear()
+            self.last_full_rebuild = time.monotonic()
+        for row in rows:
+            self.upsert(row)
+            if self.last_updated_at is None or row["updatedAt"] > self.last_updated_at:
+                self.last_updated_at = row["updatedAt"]
+        self.last_refresh = time.monotonic()
+        return len(rows)
+
+    def _matches(self, listing: dict, city=None, type=None, status=None, min_price=None, max_price=None, min_bedrooms=None):
+        if city and city.lower() not in listing["city"].lower():
+            return False
+        if type and type.lower() != listing["type"].lower():
+            return False
+        if status and status.lower() != listing["status"].lower():
+            return False
+        if min_price is not None and listing["price"] < min_price:
+            return False
+        if max_price is not None and listing["price"] > max_price:
+            return False
+        if min_bedrooms is not None and listing["bedrooms"] < min_bedrooms:
+            return False
+        return True
+
+    def search(self, query: str = "", k: int = 5, **filters) -> list:
+        """Returns up to k listings ranked for `query` that pass `filters`."""
+        filters = {key: value for key, value in filters.items() if value is not None}
+        scores = defaultdict(float)
+        total = len(self.listings) or 1
+        for tok in set(tokenize(query)) - STOPWORDS:
+            postings = self.postings.get(tok)
+            if not postings:
+                continue
+            idf = math.log(1 + total / len(postings))
+            for listing_id, weight in postings.items():
+                scores[listing_id] += idf * weight
+
+        if scores:
+            cutoff = max(scores.values()) * MIN_RELATIVE_SCORE
+            candidates = [lid for lid, score in scores.items() if score >= cutoff]
+        elif query and any(tok not in STOPWORDS for tok in tokenize(query)) and not filters:
+            return []
+        else:
+            candidates = self.listings.keys()
+
+        ranked = sorted(
+            (self.listings[lid] for lid in candidates if self._matches(self.listings[lid], **filters)),
+            key=lambda l: (scores.get(l["id"], 0.0), l["updatedAt"]),
+            reverse=True,
+        )
+        return ranked[:k]
+
+    def find(self, query: str):
+        """Best single listing for a title or slug, like the old ILIKE lookup."""
+        slug = (query or "").strip().lower()
+        if slug in self.slugs:
+            return self.listings[self.slugs[slug]]
+        results = self.search(query, k=1)
+        return results[0] if results else None
+
+
+def listing_digest(listing: dict) -> dict:
+    """The few fields the model needs about a listing, formatted once.
+
+    `cover` is the first ListingImage.url as stored (often a storage path);
+    it is signed when the digest is rendered. `updatedAt` tells a cached
+    digest apart from a newer version of the listing.
+    """
+    specs = [f"{listing['bedrooms']} BR", f"{listing['bathrooms']} BA"]
+    if listing.get("floorArea"):
+        specs.append(f"{listing['floorArea']} sqm floor")
+    if listing.get("lotArea"):
+        specs.append(f"{listing['lotArea']} sqm lot")
+    return {
+        "id": listing["id"],
+        "title": f"{listing['title']} ({listing['type']}, {listing['status']})",
+        "price": format_price(listing["price"], listing["country"]),
+        "location": f"{listing['city']}, {listing['state']}, {listing['country']}",
+        "specs": ", ".join(specs),
+        "link": f"{SITE_URL}/listing/{listing['slug']}",
+        "cover": listing.get("cover"),
+        "updatedAt": listing.get("updatedAt"),
+    }
+
+
+def render_digest(digest: dict, image_url: str = None) -> str:
+    """One compact prompt line per listing, with the link the model must use."""
+    return (
+        f"- {digest['title']} | {digest['price']} | {digest['location']} | {digest['specs']} | "
+        f"ID: {digest['id']} | Link: {digest['link']}"
+        + (f" | Image: {image_url}" if image_url else "")
+    )
+
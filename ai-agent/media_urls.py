@@ -0,0 +1,183 @@
+"""Turns ListingImage.url values into URLs a browser can load.
+
+Stored values are usually storage paths such as "images:listings/x/1.jpg"
+("bucket:object", or just "object" in the default bucket) or Supabase storage
+URLs, both of which need a signed URL. Other http(s) URLs are used as they are.
+The parsing rules match parseBucketSpec in src/lib/supabase.ts.
+
+Paths are signed in one call per bucket through a pluggable signer and each
+signed URL is cached until shortly before it expires, so a URL handed to the
+model is still valid for at least `min_ttl` seconds.
+"""
+import asyncio
+import hashlib
+import re
+import time
+from urllib.parse import quote, unquote
+
+from cache import TTLCache
+
+_STORAGE_URL_RE = re.compile(r"/storage/v1/object/(?:public|sign)/([^/]+)/(.+)$")
+
+
+def parse_storage_path(url: str, default_bucket: str = "images"):
+    """(bucket, object_path) for a value that needs signing, else None."""
+    if not url:
+        return None
+    if url.startswith(("http://", "https://")):
+        match = _STORAGE_URL_RE.search(url)
+        if not match:
+            return None
+        return unquote(match.group(1)), unquote(match.group(2).split("?")[0])
+    bucket, sep, object_path = url.partition(":")
+    if not sep:
+        return default_bucket, url
+    return bucket.strip() or default_bucket, object_path.strip()
+
+
+class SupabaseSigner:
+    """Signs object paths with the Storage API's batch endpoint (one request per bucket)."""
+
+    def __init__(self, base_url: str, service_key: str, timeout: float = 10.0):
+        self.base_url = base_url.rstrip("/")
+        self.service_key = service_key
+        self.timeout = timeout
+        self._client = None
+
+    async def __call__(self, bucket: str, paths, expires: int):
+        import httpx
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout, headers={
+                "Authorization": f"Bearer {self.service_key}",
+                "apikey": self.service_key,
+            })
+        response = await self._client.post(
+            f"{self.base_url}/storage/v1/object/sign/{quote(bucket)}",
+            json={"expiresIn": expires, "paths": list(paths)}
+        )
+        response.raise_for_status()
+        signed = {
+            item["path"]: f"{self.base_url}/storage/v1{item['signedURL']}"
+            for item in response.json() if item.get("signedURL") and not item.get("error")
+        }
+        return [signed.get(path) for path in paths]
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class StubSigner:
+    """Deterministic local signer for tests and development; makes no network calls."""
+
+    def __init__(self, base_url: str = "http://localhost:54321"):
+        self.base_url = base_url.rstrip("/")
+        self.calls = 0
+
+    async def __call__(self, bucket: str, paths, expires: int):
+        self.calls += 1
+        expires_at = int(time.time()) + expires
+        return [
+            f"{self.base_url}/storage/v1/object/sign/{quote(bucket)}/{quote(path)}"
+            f"?token={hashlib.sha1(f'{bucket}/{path}/{expires_at}'.encode()).hexdigest()[:16]}&expires={expires_at}"
+            for path in paths
+        ]
+
+
+class MediaUrlResolver:
+    """Resolves media URLs, signing storage paths in batches and caching the results.
+
+    `signer(bucket, paths, expires)` is an async callable returning one signed
+    URL (or None) per path. Without a signer, storage paths stay unresolved.
+    Signed URLs last `expires` seconds (the frontend's default is 7 days).
+    Concurrent requests for the same path share one signing call.
+    """
+
+    def __init__(self, signer=None, expires: int = 604800, min_ttl: int = 86400, max_size: int = 5000,
+                 default_bucket: str = "images"):
+        self.signer = signer
+        self.default_bucket = default_bucket
+        self.expires = expires
+        # Never keep a URL for less than half its lifetime
+        self.cache_ttl = max(expires - min_ttl, expires / 2)
+        self._cache = TTLCache(max_size, self.cache_ttl)
+        self._pending = {}
+        self.sign_calls = 0
+        self.signed = 0
+        self.failures = 0
+
+    async def resolve(self, urls) -> dict:
+        """{url: browser-loadable URL} for every url that could be resolved."""
+        resolved = {}
+        to_sign = {}
+        waiting = {}
+        for url in dict.fromkeys(urls):
+            spec = parse_storage_path(url, self.default_bucket)
+            if spec is None:
+                if url:
+                    resolved[url] = url
+                continue
+            cached = self._cache.get(spec)
+            if cached is not None:
+                resolved[url] = cached
+            elif spec in self._pending:
+                waiting[url] = self._pending[spec]
+            elif self.signer is not None:
+                to_sign.setdefault(spec, []).append(url)
+
+        if to_sign:
+            loop = asyncio.get_running_loop()
+            for spec in to_sign:
+                self._pending[spec] = loop.create_future()
+            by_bucket = {}
+            for bucket, path in to_sign:
+                by_bucket.setdefault(bucket, []).append(path)
+            try:
+                await asyncio.gather(*(self._sign_bucket(bucket, paths) for bucket, paths in by_bucket.items()))
+            finally:
+                for spec, urls_for_spec in to_sign.items():
+                    future = self._pending.pop(spec)
+                    if not future.done():
+                        future.set_result(None)
+                    for url in urls_for_spec:
+                        if future.result() is not None:
+                            resolved[url] = future.result()
+
+        for url, future in waiting.items():
+            signed = await asyncio.shield(future)
+            if signed is not None:
+                resolved[url] = signed
+        return resolved
+
+    async def _sign_bucket(self, bucket: str, paths):
+        self.sign_calls += 1
+        try:
+            signed_urls = await self.signer(bucket, paths, self.expires)
+        except Exception as e:
+            print(f"Error signing {len(paths)} media paths in bucket {bucket}: {e}")
+            self.failures += len(paths)
+            return
+        for path, signed in zip(paths, signed_urls):
+            if signed is None:
+                self.failures += 1
+            else:
+                self.signed += 1
+                self._cache.set((bucket, path), signed)
+            self._pending[(bucket, path)].set_result(signed)
+
+    async def aclose(self):
+        close = getattr(self.signer, "aclose", None)
+        if close is not None:
+            await close()
+
+    def stats(self):
+        return {
+            **self._cache.stats(),
+            "signer": type(self.signer).__name__ if self.signer is not None else None,
+            "sign_calls": self.sign_calls,
+            "signed": self.signed,
+            "failures": self.failures,
+            "cache_ttl_s": self.cache_ttl,
+        }
@@ -0,0 +1,47 @@
+import json
+
+from langchain_core.messages import BaseMessage
+
+# Where a message's classification is kept. additional_kwargs is part of the
+# chat_history JSON, so stored turns carry it, and is not sent to the provider.
+META_KEY = "meta"
+
+
+def estimate_tokens(content) -> int:
+    """Cheap token estimate (~4 characters per token) used for budgeting."""
+    return max(1, len(content if isinstance(content, str) else json.dumps(content)) // 4)
+
+
+def classify_message(content) -> dict:
+    """Single pass over a message's content.
+
+    Only image_url parts count as images: that is what the vision model is
+    actually sent. Markdown images in text, such as the listing photos in every
+    assistant reply, are just links and do not need vision.
+    """
+    images = 0
+    if isinstance(content, list):
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                images += 1
+    return {"has_image": images > 0, "images": images, "tokens": estimate_tokens(content)}
+
+
+def get_meta(message: BaseMessage) -> dict:
+    """The stored classification, computed now for messages saved before it existed."""
+    meta = message.additional_kwargs.get(META_KEY)
+    if meta is None:
+        meta = message.additional_kwargs[META_KEY] = classify_message(message.content)
+    return meta
+
+
+def with_meta(message: BaseMessage, meta: dict = None) -> BaseMessage:
+    """Attaches `meta` (or a fresh classification) to the message and returns it."""
+    message.additional_kwargs[META_KEY] = meta if meta is not None else classify_message(message.content)
+    return message
+
+
+def message_tokens(message: BaseMessage) -> int:
+    """Stored token estimate if the message has been classified, else a fresh one."""
+    meta = message.additional_kwargs.get(META_KEY)
+    return meta["tokens"] if meta else estimate_tokens(message.content)
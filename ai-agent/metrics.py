@@ -0,0 +1,183 @@
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Seconds; wide enough for a 1 ms cache hit and a 30 s model call
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, total in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {_format_value(total)}")
+        return lines
+
+
+class Histogram:
+    """Prometheus-style histogram.
+
+    observe() is a bisect and two additions, so it is cheap enough for every
+    request; buckets are made cumulative only when rendered.
+    """
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._series = {}
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = 'le="' + (bound if bound == "+Inf" else _format_value(float(bound))) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Read at scrape time from `read`, which returns a number or {label_values: number}."""
+
+    def __init__(self, name: str, help: str, read, labels=()):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = tuple(labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            current = self.read()
+        except Exception as e:
+            print(f"Error reading gauge {self.name}: {e}")
+            return lines
+        items = current.items() if isinstance(current, dict) else [((), current)]
+        for values, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help: str, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS, labels=()):
+        return self._add(Histogram(name, help, buckets, labels))
+
+    def gauge(self, name: str, help: str, read, labels=()):
+        return self._add(Gauge(name, help, read, labels))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class Trace:
+    """Per-request stage timings, returned to the caller when asked for.
+
+    `marks` holds internal timestamps (e.g. when the model call started);
+    `info` holds values reported with the timings, such as the chosen model.
+    """
+
+    __slots__ = ("id", "started", "stages", "marks", "info")
+
+    def __init__(self, trace_id: str = None):
+        self.id = trace_id or uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.marks = {}
+        self.info = {}
+
+    def add(self, stage: str, seconds: float):
+        # Stages that run more than once per request (e.g. media_fetch) add up
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "stages_ms": {stage: round(seconds * 1000, 2) for stage, seconds in self.stages.items()},
+            **self.info,
+        }
+
+
+# The trace of the request being served, if any. Background tasks run with a
+# fresh context so their work is not charged to whichever request spawned them.
+current_trace: ContextVar = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def use_trace(trace: Trace):
+    """Makes `trace` the current trace for the block."""
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        try:
+            current_trace.reset(token)
+        except ValueError:
+            # An abandoned async generator is finalized from another context
+            pass
+
+
+def record(histogram: Histogram, stage: str, seconds: float):
+    histogram.observe(seconds, stage)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def timed(histogram: Histogram, stage: str):
+    """Times the block into `histogram` (labelled by stage) and the current trace."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(histogram, stage, time.perf_counter() - start)
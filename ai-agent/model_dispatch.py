@@ -0,0 +1,211 @@
+import json
+import time
+import asyncio
+import hashlib
+
+from langchain_core.messages import message_to_dict
+
+from message_meta import message_tokens
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed instead of queued (model or database capacity).
+
+    `retry_after` is a hint, in seconds, for when capacity is expected back.
+    `rate_limited` is set when the provider budget, rather than local
+    capacity, ran out.
+    """
+
+    def __init__(self, reason: str, retry_after: float = 1.0, rate_limited: bool = False):
+        super().__init__(f"Capacity exceeded ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+        self.rate_limited = rate_limited
+
+
+class TokenBucket:
+    """Refills `per_minute` units per minute, continuously, up to one minute's worth."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float) -> float:
+        """Seconds until `amount` units are available (0 if they are now)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def refund(self, amount: float):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class ModelDispatcher:
+    """Single gateway for model calls, shared by every request in the process.
+
+    - Budgets: a requests-per-minute and a tokens-per-minute token bucket.
+      Tokens are charged up front from an estimate (prompt + `completion_reserve`)
+      and corrected with the provider's reported usage afterwards, or
+      refunded if the call fails.
+    - Concurrency: at most `max_concurrency` calls run at once.
+    - Coalescing: identical prompts to the same model that are already in
+      flight share one provider call. The call runs in its own task and is
+      cancelled only when every caller waiting on it has gone away.
+    - Queueing: at most `max_queue` calls wait; beyond that, or when the budget
+      cannot be met before a call's deadline, Overloaded is raised at once
+      instead of letting the request hang.
+
+    `on_wait`, if given, is called with the seconds each call spent queued.
+    """
+
+    def __init__(self, rpm: float, tpm: float, max_concurrency: int, max_queue: int,
+                 default_deadline: float = 30.0, completion_reserve: int = 512, on_wait=None):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.default_deadline = default_deadline
+        self.completion_reserve = completion_reserve
+        self.on_wait = on_wait
+        self._inflight = {}
+        self._slots = None
+        self._loop = None
+        self.queue_depth = 0
+        self.running = 0
+        self.metrics = {
+            "calls": 0, "coalesced": 0, "shed_queue_full": 0, "shed_deadline": 0,
+            "errors": 0, "max_queue_depth": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0,
+        }
+
+    def _semaphore(self):
+        # asyncio primitives belong to one event loop; recreate for a new one
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+            self._inflight = {}
+        return self._slots
+
+    def _key(self, model, messages) -> str:
+        payload = json.dumps(
+            [getattr(model, "model_name", type(model).__name__)] + [message_to_dict(m) for m in messages],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    async def invoke(self, model, messages, deadline: float = None, **kwargs):
+        """model.ainvoke(messages) under the dispatcher's limits."""
+        slots = self._semaphore()
+        key = self._key(model, messages)
+        call = self._inflight.get(key)
+        if call is None:
+            call = {"task": asyncio.ensure_future(self._run(slots, model, messages, deadline, **kwargs)), "waiters": 0}
+            self._inflight[key] = call
+            call["task"].add_done_callback(lambda task: self._finished(key, call))
+        else:
+            self.metrics["coalesced"] += 1
+
+        call["waiters"] += 1
+        try:
+            return await asyncio.shield(call["task"])
+        finally:
+            call["waiters"] -= 1
+            # The last caller gave up (e.g. its client disconnected): stop the call
+            if call["waiters"] == 0 and not call["task"].done():
+                call["task"].cancel()
+
+    def _finished(self, key: str, call: dict):
+        if self._inflight.get(key) is call:
+            del self._inflight[key]
+        if not call["task"].cancelled():
+            # Avoid "exception was never retrieved" when every caller was cancelled
+            call["task"].exception()
+
+    async def _run(self, slots, model, messages, deadline, **kwargs):
+        if self.queue_depth >= self.max_queue:
+            self.metrics["shed_queue_full"] += 1
+            raise Overloaded("queue full", retry_after=self._retry_after())
+
+        deadline = time.monotonic() + (self.default_deadline if deadline is None else deadline)
+        estimate = sum(message_tokens(m) for m in messages) + self.completion_reserve
+        queued_at = time.monotonic()
+        self.queue_depth += 1
+        self.metrics["max_queue_depth"] = max(self.metrics["max_queue_depth"], self.queue_depth)
+        acquired = False
+        try:
+            try:
+                await asyncio.wait_for(slots.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+                acquired = True
+            except asyncio.TimeoutError:
+                self.metrics["shed_deadline"] += 1
+                raise Overloaded("no free slot before deadline", retry_after=self._retry_after())
+
+            while True:
+                delay = max(self.requests.time_until(1), self.tokens.time_until(estimate))
+                if delay <= 0:
+                    self.requests.consume(1)
+                    self.tokens.consume(estimate)
+                    break
+                if time.monotonic() + delay > deadline:
+                    self.metrics["shed_deadline"] += 1
+                    raise Overloaded("rate budget exhausted", retry_after=delay, rate_limited=True)
+                await asyncio.sleep(delay)
+        except BaseException:
+            if acquired:
+                slots.release()
+            raise
+        finally:
+            self.queue_depth -= 1
+            waited_ms = (time.monotonic() - queued_at) * 1000
+            self.metrics["wait_ms_total"] += waited_ms
+            self.metrics["wait_ms_max"] = max(self.metrics["wait_ms_max"], waited_ms)
+            if self.on_wait is not None:
+                self.on_wait(waited_ms / 1000)
+
+        self.running += 1
+        self.metrics["calls"] += 1
+        try:
+            result = await model.ainvoke(messages, **kwargs)
+        except Exception:
+            self.metrics["errors"] += 1
+            # Nothing was generated; give the up-front estimate back
+            self.tokens.refund(estimate)
+            raise
+        finally:
+            self.running -= 1
+            slots.release()
+
+        usage = getattr(result, "usage_metadata", None)
+        if usage and usage.get("total_tokens"):
+            # Settle the up-front estimate against what the provider reported
+            self.tokens.consume(usage["total_tokens"] - estimate)
+        return result
+
+    def _retry_after(self) -> float:
+        return max(1.0, self.requests.time_until(1), self.tokens.time_until(self.completion_reserve))
+
+    def stats(self):
+        m = dict(self.metrics)
+        waits = m["calls"] + m["shed_deadline"]
+        m["wait_ms_avg"] = round(m.pop("wait_ms_total") / waits, 2) if waits else 0.0
+        m["wait_ms_max"] = round(m["wait_ms_max"], 2)
+        m.update(
+            queue_depth=self.queue_depth,
+            running=self.running,
+            in_flight_prompts=len(self._inflight),
+            rpm_available=round(self.requests.level, 1),
+            tpm_available=round(self.tokens.level, 1),
+        )
+        return m
@@ -0,0 +1,88 @@
+import json
+import hashlib
+
+from langchain_core.messages import SystemMessage, HumanMessage
+
+from cache import TTLCache
+from message_meta import estimate_tokens, message_tokens, with_meta
+
+# Dynamic prompt sections, in the order they are appended after the history
+SECTION_ORDER = ("user", "summary", "context", "viewing", "media", "listings", "vision")
+
+
+class PromptBuilder:
+    """Assembles model input as a stable prefix plus an ordered dynamic suffix.
+
+    The static system prompt is always the first message and is byte-for-byte
+    identical on every call, followed by the conversation history, so the
+    provider can reuse its cached prefix across turns. Per-turn sections
+    (user info, summary, website context, listings the user is viewing,
+    media, retrieved listings, vision hint) go into a second system message just before the new user message.
+
+    Rendered sections are memoized by a hash of their input together with
+    their token estimate, and per-section token counts are aggregated for
+    `stats`.
+    """
+
+    def __init__(self, prefix: str, cache_size: int = 1024, ttl: float = 3600.0):
+        self.prefix = prefix
+        self.prefix_tokens = estimate_tokens(prefix)
+        self._rendered = TTLCache(cache_size, ttl)
+        self.builds = 0
+        self.section_totals = {}
+
+    def render(self, name: str, data, renderer):
+        """Returns renderer(data), memoized by section name and input hash."""
+        if not data:
+            return None
+        digest = hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+        key = (name, digest)
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            text = renderer(data)
+            rendered = (text, estimate_tokens(text))
+            self._rendered.set(key, rendered)
+        return rendered
+
+    def section(self, text: str):
+        """Wraps an uncached per-turn section in the same (text, tokens) shape."""
+        return (text, estimate_tokens(text)) if text else None
+
+    def build(self, sections: dict, history: list, message_content, meta: dict = None):
+        """Returns (messages, token_counts) for one model call.
+
+        `sections` maps names from SECTION_ORDER to the (text, tokens) pairs
+        produced by `render` / `section`; missing or empty ones are skipped.
+        `meta` is the new message's classification (see message_meta.py),
+        attached to the HumanMessage so the model call can route on it.
+        """
+        counts = {"prefix": self.prefix_tokens}
+        suffix = []
+        for name in SECTION_ORDER:
+            rendered = sections.get(name)
+            if rendered:
+                suffix.append(rendered[0])
+                counts[name] = rendered[1]
+        counts["history"] = sum(message_tokens(m) for m in history)
+        counts["message"] = meta["tokens"] if meta else estimate_tokens(message_content)
+        counts["total"] = sum(counts.values())
+
+        self.builds += 1
+        for name, tokens in counts.items():
+            self.section_totals[name] = self.section_totals.get(name, 0) + tokens
+
+        messages = [SystemMessage(content=self.prefix)] + list(history)
+        if suffix:
+            messages.append(SystemMessage(content="".join(suffix)))
+        messages.append(with_meta(HumanMessage(content=message_content), meta))
+        return messages, counts
+
+    def stats(self):
+        """Average prompt tokens per section across builds, plus memo cache counters."""
+        return {
+            "builds": self.builds,
+            "avg_tokens": {
+                name: round(total / self.builds, 1) for name, total in self.section_totals.items()
+            } if self.builds else {},
+            "render_cache": self._rendered.stats(),
+        }
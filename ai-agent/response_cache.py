@@ -0,0 +1,102 @@
+import re
+import math
+import zlib
+import hashlib
+
+from cache import TTLCache
+
+_NON_WORD_RE = re.compile(r"[^a-z0-9₱$ ]+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_message(text: str) -> str:
+    """Lowercases and strips punctuation so trivially different phrasings share a key."""
+    text = _NON_WORD_RE.sub(" ", (text or "").lower())
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def context_hash(additional_context) -> str:
+    return hashlib.sha1((additional_context or "").encode()).hexdigest()
+
+
+def ngram_embedding(text: str, buckets: int = 4096) -> dict:
+    """Local, dependency-free embedding: hashed character trigrams, L2-normalized.
+
+    Returned as a sparse {bucket: weight} dict. Good at catching re-wordings
+    and typos of the same short question; swap in a real sentence embedding
+    through ResponseCache(embed=...) if one is available.
+    """
+    vector = {}
+    for word in text.split():
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            bucket = zlib.crc32(padded[i:i + 3].encode()) % buckets
+            vector[bucket] = vector.get(bucket, 0.0) + 1.0
+    norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+    return {k: v / norm for k, v in vector.items()}
+
+
+def cosine(a: dict, b: dict) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
+
+
+class ResponseCache:
+    """Caches replies to context-free questions such as "who are you".
+
+    Exact tier: keyed by the normalized message plus a hash of the website
+    context. Similarity tier (enabled when `similarity_threshold` > 0): the
+    closest cached message under the same context hash is reused if its
+    embedding cosine is at least the threshold. Both tiers share the size
+    bound and TTL; `clear` drops everything, e.g. when listings change.
+    """
+
+    def __init__(self, max_size: int, ttl: float, similarity_threshold: float = 0.0, embed=ngram_embedding):
+        self.similarity_threshold = similarity_threshold
+        self.embed = embed
+        self._entries = TTLCache(max_size, ttl)
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def lookup(self, text: str, context: str):
+        key = (context, normalize_message(text))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.exact_hits += 1
+            return entry["response"]
+
+        if self.similarity_threshold > 0:
+            vector = self.embed(key[1])
+            best, best_score = None, self.similarity_threshold
+            for (entry_context, _), entry in self._entries.items():
+                if entry_context != context:
+                    continue
+                score = cosine(vector, entry["vector"])
+                if score >= best_score:
+                    best, best_score = entry, score
+            if best is not None:
+                self.similar_hits += 1
+                return best["response"]
+
+        self.misses += 1
+        return None
+
+    def store(self, text: str, context: str, response: str):
+        normalized = normalize_message(text)
+        vector = self.embed(normalized) if self.similarity_threshold > 0 else None
+        self._entries.set((context, normalized), {"response": response, "vector": vector})
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        total = self.exact_hits + self.similar_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.exact_hits + self.similar_hits) / total, 3) if total else 0.0,
+        }
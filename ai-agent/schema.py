@@ -0,0 +1,38 @@
+"""Creates the tables the AI agent owns (chat_history, chat_summary).
+
+Run once per deploy, before starting the API, instead of from every worker:
+
+    python schema.py
+"""
+import sys
+
+import psycopg
+from langchain_postgres import PostgresChatMessageHistory
+
+from agent import DB_URL
+
+
+def create_tables(conn):
+    # Also creates idx_chat_history_session_id (session_id); schema.prisma declares
+    # it too, so `prisma db push` does not drop it only for the next start to rebuild it
+    PostgresChatMessageHistory.create_tables(conn, "chat_history")
+    # Serves the newest-first window reads (ORDER BY id DESC LIMIT n) per session
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_session_id_id ON chat_history (session_id, id)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS chat_summary ("
+        "session_id TEXT PRIMARY KEY, "
+        "summary TEXT NOT NULL, "
+        "last_message_id INTEGER NOT NULL, "
+        "updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW())"
+    )
+    conn.commit()
+
+
+if __name__ == "__main__":
+    try:
+        with psycopg.connect(DB_URL) as conn:
+            create_tables(conn)
+        print("Database tables 'chat_history' and 'chat_summary' initialized.")
+    except Exception as e:
+        print(f"Error initializing database: {e}")
+        sys.exit(1)
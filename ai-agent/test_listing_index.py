@@ -0,0 +1,46 @@
+from datetime import datetime
+
+from listing_index import ListingIndex, parse_query
+
+
+def make_listing(id, title, city, type, status, price, bedrooms, updated_day=1):
+    return {
+        "id": id, "title": title, "slug": title.lower().replace(" ", "-"), "city": city,
+        "state": "Metro Manila", "country": "Philippines", "type": type, "status": status,
+        "price": price, "bedrooms": bedrooms, "bathrooms": 1, "floorArea": None, "lotArea": None,
+        "indoorFeatures": [], "outdoorFeatures": [], "published": True,
+        "updatedAt": datetime(2024, 1, updated_day), "cover": None,
+    }
+
+
+def test_distances_and_durations_are_not_prices():
+    assert "max_price" not in parse_query("a condo within 10 minutes of the airport")
+    assert "max_price" not in parse_query("less than 3 km from the beach")
+    assert "min_price" not in parse_query("at least 2 floors")
+
+
+def test_price_bounds():
+    assert parse_query("condo under 5M")["max_price"] == 5_000_000
+    assert parse_query("house below 8,000,000")["max_price"] == 8_000_000
+    assert parse_query("above 20k for rent") == {"min_price": 20_000, "status": "for rent"}
+    assert parse_query("3 bedroom below ₱800")["max_price"] == 800
+
+
+def test_small_plain_numbers_are_not_prices():
+    assert parse_query("under 50") == {}
+
+
+def test_search_applies_parsed_filters():
+    index = ListingIndex()
+    index.upsert(make_listing("a", "Makati Sky Condo", "Makati", "Condo", "For Sale", 4_500_000, 2))
+    index.upsert(make_listing("b", "Makati Grand Condo", "Makati", "Condo", "For Sale", 9_000_000, 3))
+    index.upsert(make_listing("c", "Taguig Rental Condo", "Taguig", "Condo", "For Rent", 30_000, 1))
+    unpublished = make_listing("d", "Makati Draft Condo", "Makati", "Condo", "For Sale", 1_000_000, 2)
+    unpublished["published"] = False
+    index.upsert(unpublished)
+
+    query = "makati condo under 5M within 10 minutes of the mall"
+    assert [l["id"] for l in index.search(query, **parse_query(query))] == ["a"]
+    assert [l["id"] for l in index.search("condo", min_bedrooms=3)] == ["b"]
+    assert [l["id"] for l in index.search("", status="for rent")] == ["c"]
+    assert index.find("makati-sky-condo")["id"] == "a"
@@ -0,0 +1,43 @@
+from agent import BlockSafeBuffer
+
+REPLY = "Here you go: [CHOICES]Buy|Rent[/CHOICES] Or [AGENT_CARD]{\"name\": \"Ana\"}[/AGENT_CARD] see [this](https://x.test)."
+
+
+def feed_all(chunks):
+    buffer = BlockSafeBuffer()
+    out = [buffer.feed(chunk) for chunk in chunks]
+    return out, buffer.flush()
+
+
+def test_split_opening_tag():
+    out, rest = feed_all(["Hi [CHO", "ICES]Yes|No[/CHOICES] bye"])
+    assert out == ["Hi ", "[CHOICES]Yes|No[/CHOICES] bye"]
+    assert rest == ""
+
+
+def test_split_closing_tag():
+    out, rest = feed_all(["[CHOICES]Yes|No[/CHO", "ICES]", "!"])
+    assert out == ["", "[CHOICES]Yes|No[/CHOICES]", "!"]
+    assert rest == ""
+
+
+def test_unclosed_block_is_held_until_flush():
+    out, rest = feed_all(["Meet ", "[AGENT_CARD]{\"name\": ", "\"Ana\"}"])
+    assert out == ["Meet ", "", ""]
+    assert rest == "[AGENT_CARD]{\"name\": \"Ana\"}"
+
+
+def test_plain_brackets_are_not_held():
+    out, rest = feed_all(["See [this", "](https://x.test) and [note] here"])
+    assert "".join(out) == "See [this](https://x.test) and [note] here"
+    assert rest == ""
+
+
+def test_blocks_are_never_split_at_any_chunk_boundary():
+    for size in range(1, 12):
+        chunks = [REPLY[i:i + size] for i in range(0, len(REPLY), size)]
+        out, rest = feed_all(chunks)
+        assert "".join(out) + rest == REPLY
+        for segment in out:
+            for tag in ("CHOICES", "AGENT_CARD"):
+                assert segment.count(f"[{tag}]") == segment.count(f"[/{tag}]"), (size, segment)